@@ -0,0 +1,164 @@
+"""
+Benchmarks for the codec, open, write, export and import paths of pyphotonfile on synthetic files. Reports throughput
+and peak memory per operation and saves the results as JSON, which can be compared against a previous run:
+
+    python -m benchmarks.bench --layers 200 --aa 1 --complexity realistic --output results.json
+    python -m benchmarks.bench --layers 200 --compare results.json
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import PIL
+from pyphotonfile import Photon
+from pyphotonfile import photonfile
+
+from . import synthetic
+
+
+def measure(func, repeat=3):
+    """
+    Runs func repeat times and returns the best time in seconds and the peak memory in bytes of an additional run
+    traced with tracemalloc (numpy allocations are included).
+    """
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        seconds.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return min(seconds), peak
+
+
+def operations(filepath, workdir, workers=None):
+    """
+    Returns a dict of the benchmarked operations. Every operation is a function without arguments.
+    """
+    photon = Photon(filepath)
+    shape = (photon.resolution_y, photon.resolution_x)
+    payloads = [sublayer._data for layer in photon.layers for sublayer in layer.sublayers]
+    imgarrs = photonfile.rle_to_imgstack(payloads, shape=shape, dtype=bool)
+    exportdir = os.path.join(workdir, 'export')
+    photon.export_images(exportdir, mode='1')
+    out = np.empty(shape, dtype=np.uint8)
+
+    def export_images():
+        shutil.rmtree(os.path.join(workdir, 'export_bench'), ignore_errors=True)
+        photon.export_images(os.path.join(workdir, 'export_bench'), workers=workers)
+
+    def append_layers():
+        new = Photon(filepath, header_only=True)
+        new.delete_layers()
+        new.append_layers(exportdir, workers=workers)
+
+    return {
+        'decode': lambda: [photonfile.rle_to_imgarray(payload, out=out) for payload in payloads],
+        'encode': lambda: [photonfile.imgarr_to_rle(imgarr) for imgarr in imgarrs],
+        'open': lambda: Photon(filepath),
+        'open_memory_map': lambda: Photon(filepath, memory_map=True),
+        'open_header_only': lambda: Photon(filepath, header_only=True),
+        'write': lambda: photon.write(os.path.join(workdir, 'write.photon')),
+        'write_dedup': lambda: photon.write(os.path.join(workdir, 'write.photon'), dedup=True),
+        'statistics': lambda: photon.statistics(workers=workers),
+        'footprint': lambda: photon.footprint(workers=workers),
+        'export_images': export_images,
+        'append_layers': append_layers,
+    }
+
+
+def run(n_layers=100, anti_aliasing_level=1, complexity='realistic', workers=None, repeat=3, selected=None):
+    """
+    Generates a synthetic file and benchmarks all (or the selected) operations on it. Returns the results as dict.
+    """
+    workdir = tempfile.mkdtemp(prefix='pyphotonfile_bench_')
+    try:
+        filepath = os.path.join(workdir, 'synthetic.photon')
+        synthetic.generate(filepath, n_layers, anti_aliasing_level, complexity)
+        file_bytes = os.path.getsize(filepath)
+        n_sublayers = n_layers * max(anti_aliasing_level, 1)
+        results = {}
+        for name, func in operations(filepath, workdir, workers).items():
+            if selected and name not in selected:
+                continue
+            seconds, peak = measure(func, repeat)
+            results[name] = {
+                'seconds': seconds,
+                'layers_per_second': n_sublayers / seconds,
+                'mb_per_second': file_bytes / seconds / 2**20,
+                'peak_memory_mb': peak / 2**20,
+            }
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return {
+        'parameters': {
+            'layers': n_layers,
+            'anti_aliasing_level': anti_aliasing_level,
+            'complexity': complexity,
+            'workers': workers,
+            'repeat': repeat,
+            'file_mb': file_bytes / 2**20,
+        },
+        'environment': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'pillow': PIL.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'date': datetime.datetime.now().isoformat(),
+        },
+        'results': results,
+    }
+
+
+def report(benchmark, baseline=None):
+    """
+    Returns the results as text table. If a baseline benchmark is given, the speedup against it is added.
+    """
+    lines = ['{:<18} {:>10} {:>10} {:>10} {:>10}'.format('operation', 'seconds', 'layers/s', 'MB/s', 'peak MB')]
+    for name, result in benchmark['results'].items():
+        line = '{:<18} {:>10.4f} {:>10.1f} {:>10.1f} {:>10.1f}'.format(
+            name, result['seconds'], result['layers_per_second'], result['mb_per_second'], result['peak_memory_mb'])
+        if baseline is not None and name in baseline['results']:
+            line += ' {:>7.2f}x'.format(baseline['results'][name]['seconds'] / result['seconds'])
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks pyphotonfile on synthetic Photon-files.')
+    parser.add_argument('--layers', type=int, default=100)
+    parser.add_argument('--aa', type=int, default=1, help='anti-aliasing level')
+    parser.add_argument('--complexity', choices=synthetic.COMPLEXITIES, default='realistic')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes for parallel operations')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--only', nargs='+', help='only run these operations')
+    parser.add_argument('--output', help='save the results to this JSON file')
+    parser.add_argument('--compare', help='JSON file of a previous run to compare against')
+    args = parser.parse_args(argv)
+
+    benchmark = run(args.layers, args.aa, args.complexity, args.workers, args.repeat, args.only)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print(report(benchmark, baseline))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(benchmark, f, indent=2)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
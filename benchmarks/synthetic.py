@@ -0,0 +1,98 @@
+"""
+Generator for synthetic Photon-files used by the benchmarks. Layers get encoded and streamed to disk one by one, so
+files with many layers can be generated without holding them in memory.
+"""
+import numpy as np
+from pyphotonfile import Photon, PhotonWriter
+
+COMPLEXITIES = ['empty', 'solid', 'noisy', 'realistic']
+
+
+def make_photon(anti_aliasing_level=1):
+    """
+    Returns a new Photon without layers. Files with anti_aliasing_level > 1 get converted to version 2 with default
+    print properties, as anti-aliasing is not supported by version 1.
+    """
+    photon = Photon()
+    photon.set_anti_aliasing_level(anti_aliasing_level)
+    return photon
+
+
+def layer_images(i, n_layers, complexity='realistic', levels=1, shape=(2560, 1440), rng=None):
+    """
+    Returns a list with one bool image per level for layer i of n_layers.
+        empty: no exposed pixels.
+        solid: a block covering most of the build plate.
+        noisy: randomly exposed pixels (5%), a worst case for the RLE encoding.
+        realistic: a sphere standing on supports with a raft. levels shrink the shapes by a pixel each.
+    """
+    if rng is None:
+        rng = np.random.default_rng(i)
+    rows, columns = shape
+    if complexity == 'empty':
+        return [np.zeros(shape, dtype=bool) for _ in range(levels)]
+    if complexity == 'solid':
+        image = np.zeros(shape, dtype=bool)
+        image[rows // 20:rows - rows // 20, columns // 20:columns - columns // 20] = True
+        return [image] * levels
+    if complexity == 'noisy':
+        return [rng.random(shape) < 0.05 for _ in range(levels)]
+    if complexity != 'realistic':
+        raise ValueError('complexity must be one of {}'.format(COMPLEXITIES))
+
+    center_y, center_x = rows / 2, columns / 2
+    radius = min(rows, columns) * 0.35
+    z = i / max(n_layers - 1, 1)   # relative height of the layer
+    images = []
+    for level in range(levels):
+        image = np.zeros(shape, dtype=bool)
+        if z < 0.05:    # raft
+            image[rows // 8:rows - rows // 8, columns // 8:columns - columns // 8] = True
+        elif z < 0.25:  # supports on a grid under the sphere
+            for sy in np.linspace(center_y - radius * 0.7, center_y + radius * 0.7, 5):
+                for sx in np.linspace(center_x - radius * 0.7, center_x + radius * 0.7, 5):
+                    _draw_circle(image, sy, sx, 6 - level)
+        else:   # sphere from 0.25 to 1.0
+            section = radius ** 2 - (radius * (2 * (z - 0.25) / 0.75 - 1)) ** 2
+            if section > 0:
+                _draw_circle(image, center_y, center_x, np.sqrt(section) - level)
+        images.append(image)
+    return images
+
+
+def _draw_circle(image, center_y, center_x, radius):
+    """
+    Exposes a filled circle in image, only touching the pixels of its bounding box.
+    """
+    if radius <= 0:
+        return
+    top, bottom = max(int(center_y - radius), 0), min(int(center_y + radius) + 1, image.shape[0])
+    left, right = max(int(center_x - radius), 0), min(int(center_x + radius) + 1, image.shape[1])
+    y, x = np.ogrid[top:bottom, left:right]
+    image[top:bottom, left:right] |= (y - center_y) ** 2 + (x - center_x) ** 2 < radius ** 2
+
+
+def generate(filepath, n_layers, anti_aliasing_level=1, complexity='realistic', seed=0):
+    """
+    Writes a synthetic Photon-file with n_layers layers to filepath. Use the extension .cbddlp for files with
+    anti-aliasing. Returns the Photon used for the header values.
+    """
+    photon = make_photon(anti_aliasing_level)
+    shape = (photon.resolution_y, photon.resolution_x)
+    rng = np.random.default_rng(seed)
+    with PhotonWriter(filepath, n_layers, photon) as writer:
+        for i in range(n_layers):
+            writer.add_layer(layer_images(i, n_layers, complexity, photon.layer_levels, shape, rng))
+    return photon
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Generates a synthetic Photon-file.')
+    parser.add_argument('filepath')
+    parser.add_argument('--layers', type=int, default=100)
+    parser.add_argument('--aa', type=int, default=1, help='anti-aliasing level')
+    parser.add_argument('--complexity', choices=COMPLEXITIES, default='realistic')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    generate(args.filepath, args.layers, args.aa, args.complexity, args.seed)
@@ -42,8 +42,10 @@ print(photon.preview_highres_resolution_x)
 print(photon.preview_highres_resolution_y)
 print(photon.preview_lowres_resolution_x)
 print(photon.preview_lowres_resolution_y)
-print(len(photon.preview_highres_data)) # don't print the raw data. the preview images are not yet parsed. interested in implementing something?
-print(len(photon.preview_lowres_data)) # don't print the raw data. the preview images are not yet parsed. interested in implementing something?
+print(len(photon.preview_highres_data)) # don't print the raw data. use get_preview to decode it
+print(len(photon.preview_lowres_data)) # don't print the raw data. use get_preview to decode it
+photon.get_preview('highres')   # preview image as RGB numpy array. as_image=True returns a PIL image
+photon.set_preview("preview.png", 'lowres')   # replaces the preview. accepts a path, PIL image or RGB numpy array
 
 if photon.version > 1:
     print(photon.anti_aliasing_level)
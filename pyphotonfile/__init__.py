@@ -1,2 +1,2 @@
 #from .package import Class
-from .photonfile import Photon
\ No newline at end of file
+from .photonfile import Photon, PhotonWriter, BitStack, Profiler, validate_file, validate_files
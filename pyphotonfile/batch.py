@@ -0,0 +1,259 @@
+"""
+Batch processing of many Photon-files with a pipeline of operations:
+
+    pipeline = ['validate', ('set', {'exposure_time': 8}), 'preview', ('write', {'dirpath': 'out'})]
+    for result in batch.run(glob.glob('spool/*.photon'), pipeline, workers=4, memory_limit=2 * 2**30):
+        print(result['filepath'], result['error'] or 'ok')
+
+Small files are processed in a pool of processes, one file per task. Large files are processed one after another
+with the layer operations split into chunks across half of the workers (see the workers arguments of Photon), while
+the other half keeps processing small files, so that a single huge file neither blocks one worker for the whole batch
+nor the batch itself. Files are scheduled from the largest to the smallest.
+"""
+import collections
+import concurrent.futures
+import os
+import time
+import traceback
+
+import numpy as np
+from PIL import Image
+
+from .photonfile import LayerParameters, Photon, field_value, header_fields, validate_file
+
+OPERATIONS = {}
+
+
+def operation(name, check=None):
+    """
+    Registers a function(photon, filepath, workers, **kwargs) as operation, which can be used in pipelines by name.
+    check(kwargs) returns the kwargs converted to the types the operation expects and raises ValueError for invalid
+    ones. It is called before any file is opened.
+    """
+    def register(func):
+        func.check = check
+        OPERATIONS[name] = func
+        return func
+    return register
+
+
+@operation('validate')
+def _validate(photon, filepath, workers, stop=True):
+    problems = validate_file(filepath)
+    if problems and stop:   # the following operations are skipped for broken files
+        raise ValueError('; '.join(problems))
+    return problems
+
+
+def _check_set(values):
+    formats = header_fields(2)  # the fields of all versions
+    for name, value in values.items():
+        if name not in formats:
+            raise ValueError('{} can not be set, use one of {}'.format(name, ', '.join(formats)))
+    return {name: field_value(name, value, formats[name]) for name, value in values.items()}
+
+
+def _check_layer_parameters(parameters):
+    for name in parameters:
+        if name not in LayerParameters.columns:
+            raise ValueError('{} is not a layer parameter, use one of {}'.format(name, ', '.join(LayerParameters.columns)))
+    return {name: None if value is None else field_value(name, value, 'f') for name, value in parameters.items()}
+
+
+@operation('set', _check_set)
+def _set(photon, filepath, workers, **values):
+    formats = header_fields(photon.version)
+    for name, value in values.items():
+        if name not in formats:     # print properties of version 2
+            raise ValueError('{} can not be set in files of version {}'.format(name, photon.version))
+        setattr(photon, name, value)
+
+
+@operation('layer_parameters', _check_layer_parameters)
+def _layer_parameters(photon, filepath, workers, layer_thickness=None, exposure_time=None, off_time=None):
+    photon.overwrite_layer_parameters(layer_thickness, exposure_time, off_time)
+
+
+@operation('statistics')
+def _statistics(photon, filepath, workers):
+    return photon.statistics(workers)
+
+
+@operation('print_properties')
+def _print_properties(photon, filepath, workers, density=1.1, cost_per_ml=None):
+    statistics = photon.update_print_properties(density, cost_per_ml, workers)
+    return statistics['volume_ml']
+
+
+@operation('preview')
+def _preview(photon, filepath, workers):
+    heatmap = photon.footprint(workers)['heatmap']
+    image = render_heatmap(heatmap)
+    for which in ['highres', 'lowres']:
+        size = (getattr(photon, 'preview_{}_resolution_x'.format(which)), getattr(photon, 'preview_{}_resolution_y'.format(which)))
+        photon.set_preview(_fit(image, size), which)
+
+
+@operation('write')
+def _write(photon, filepath, workers, dirpath=None, suffix='', dedup=False):
+    if dirpath is None and not suffix:
+        photon.save_in_place()
+        return filepath
+    root, ext = os.path.splitext(os.path.basename(filepath))
+    out_filepath = os.path.join(dirpath or os.path.dirname(filepath), root + suffix + ext)
+    photon.write(out_filepath, dedup)
+    return out_filepath
+
+
+def render_heatmap(heatmap):
+    """
+    Returns a PIL image of an exposure heatmap (see Photon.footprint): never exposed pixels are black, the most
+    exposed ones white.
+    """
+    scale = 255 / max(int(heatmap.max()), 1)
+    return Image.fromarray((heatmap * scale).astype(np.uint8), 'L').convert('RGB')
+
+
+def _fit(image, size):
+    """
+    Scales image to fit into size (columns, rows) keeping its aspect ratio, rotated if the orientations differ.
+    """
+    if (image.width > image.height) != (size[0] > size[1]):
+        image = image.transpose(Image.ROTATE_90)
+    image = image.copy()
+    image.thumbnail(size)
+    canvas = Image.new('RGB', size)
+    canvas.paste(image, ((size[0] - image.width) // 2, (size[1] - image.height) // 2))
+    return canvas
+
+
+def _steps(pipeline):
+    """
+    Normalizes the steps of a pipeline to (name, function, kwargs). Steps are names of operations, tuples of name and
+    kwargs or functions(photon, filepath, workers) returning a result.
+    """
+    steps = []
+    for step in pipeline:
+        if callable(step):
+            steps.append((step.__name__, step, {}))
+            continue
+        if isinstance(step, str):
+            step = (step,)
+        name, kwargs = step[0], dict(step[1]) if len(step) > 1 else {}
+        if name not in OPERATIONS:
+            raise ValueError('unknown operation {}, use one of {}'.format(name, sorted(OPERATIONS)))
+        func = OPERATIONS[name]
+        if func.check is not None:
+            kwargs = func.check(kwargs)
+        steps.append((name, func, kwargs))
+    return steps
+
+
+def process_file(filepath, pipeline, workers=None):
+    """
+    Opens the Photon-file at filepath and applies the pipeline to it. workers > 1 are used for the layer operations.
+    Errors are caught, so that a broken file does not stop the batch. Returns a dict with filepath, error (None or
+    the formatted exception), the results of the steps by name and the elapsed seconds.
+    """
+    start = time.perf_counter()
+    results = {}
+    error = None
+    try:
+        steps = _steps(pipeline)
+        with Photon(filepath, memory_map=True) as photon:
+            for name, func, kwargs in steps:
+                results[name] = func(photon, filepath, workers, **kwargs)
+    except Exception:
+        error = traceback.format_exc()
+    return {'filepath': filepath, 'error': error, 'results': results, 'seconds': time.perf_counter() - start}
+
+
+def _process_file(task):
+    return process_file(*task)
+
+
+def memory_estimate(filepath):
+    """
+    Rough estimate of the memory in bytes needed to process a file: its size (layer data might get copied by
+    operations) plus a few image sized buffers.
+    """
+    size = os.path.getsize(filepath)
+    photon = Photon(filepath, header_only=True)
+    return size + 16 * photon.resolution_x * photon.resolution_y
+
+
+def run(filepaths, pipeline, workers=None, memory_limit=None, large_file=256 * 2**20, progress=None):
+    """
+    Applies the pipeline (see process_file) to all files and yields the results as they finish. Files are scheduled
+    from the largest to the smallest. Files larger than large_file bytes are processed one at a time in a thread of
+    this process with the layer operations split across half of the workers, while the other half processes smaller
+    files in a pool of processes, one file per task. memory_limit in bytes limits the sum of memory_estimate of all
+    files being processed at once (a single file is always processed). progress(done, total, result) gets called for
+    each finished file.
+    """
+    _steps(pipeline)    # fails early for unknown operations and invalid arguments
+    file_sizes, estimates = {}, {}
+    for filepath in filepaths:
+        try:
+            file_sizes[filepath] = os.path.getsize(filepath)
+            estimates[filepath] = memory_estimate(filepath)
+        except Exception:   # unreadable files report their error when they get processed
+            file_sizes.setdefault(filepath, 0)
+            estimates[filepath] = 0
+    order = sorted(filepaths, key=lambda filepath: -file_sizes[filepath])
+    total = len(order)
+    done = 0
+
+    def finished(result):
+        nonlocal done
+        done += 1
+        if progress is not None:
+            progress(done, total, result)
+        return result
+
+    if workers is None or workers <= 1:
+        for filepath in order:
+            yield finished(process_file(filepath, pipeline))
+        return
+
+    large_workers = max(1, workers // 2)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=1) as large_executor:
+        pending = {}    # future -> (filepath, slots)
+        queue = collections.deque(order)
+        while queue or pending:
+            # submit while there are free slots and the memory ceiling allows it. a large file uses large_workers slots
+            while queue:
+                used_slots = sum(slots for _, slots in pending.values())
+                used_memory = sum(estimates[filepath] for filepath, _ in pending.values())
+                large_running = any(file_sizes[filepath] >= large_file for filepath, _ in pending.values())
+                index = 0
+                if file_sizes[queue[0]] >= large_file and large_running:
+                    # large files run one at a time, meanwhile the next small file may start
+                    index = next((i for i, filepath in enumerate(queue) if file_sizes[filepath] < large_file), None)
+                    if index is None:
+                        break
+                filepath = queue[index]
+                large = file_sizes[filepath] >= large_file
+                slots = large_workers if large else 1
+                if pending and (used_slots + slots > workers or
+                                memory_limit is not None and used_memory + estimates[filepath] > memory_limit):
+                    break
+                del queue[index]
+                try:
+                    if large:
+                        future = large_executor.submit(process_file, filepath, pipeline, large_workers)
+                    else:
+                        future = executor.submit(_process_file, (filepath, pipeline))
+                except concurrent.futures.BrokenExecutor:    # the pool died, e.g. a worker ran out of memory
+                    yield finished({'filepath': filepath, 'error': traceback.format_exc(), 'results': {}, 'seconds': 0.0})
+                    continue
+                pending[future] = (filepath, slots)
+            completed, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in completed:
+                filepath, _ = pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception:   # e.g. a worker killed by running out of memory
+                    result = {'filepath': filepath, 'error': traceback.format_exc(), 'results': {}, 'seconds': 0.0}
+                yield finished(result)
@@ -0,0 +1,283 @@
+"""
+Command line interface of pyphotonfile. Subcommands only read the parts of a file they need:
+
+    pyphotonfile info print.photon --json
+    pyphotonfile extract print.photon layers/ --layers 100:200 --mode 1 --workers 4
+    pyphotonfile pack layers/ print.photon --template print.photon --workers 4
+    pyphotonfile set print.photon exposure_time=8 --layer-parameters exposure_time=8
+    pyphotonfile stats print.photon --workers 4
+    pyphotonfile diff a.photon b.photon
+    pyphotonfile validate spool/*.photon --workers 4
+    pyphotonfile batch spool/*.photon --set exposure_time=8 --preview --output-dir out --workers 4
+"""
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+
+from . import batch as batch_
+from .photonfile import BitStack, LayerParameters, Photon, PhotonWriter, field_value, header_fields, layer_files, validate_files
+
+
+def _layers(text):
+    """
+    Parses a layer selection like '5', '10:20' or '::2' (python slice syntax) to a slice.
+    """
+    parts = text.split(':')
+    if len(parts) > 3:
+        raise argparse.ArgumentTypeError('invalid layer selection {}'.format(text))
+    try:
+        values = [int(part) if part else None for part in parts]
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid layer selection {}'.format(text))
+    if len(values) == 1:
+        if values[0] is None:
+            raise argparse.ArgumentTypeError('invalid layer selection {}'.format(text))
+        return slice(values[0], values[0] + 1 if values[0] != -1 else None)
+    return slice(*values)
+
+
+def _print_values(values, as_json):
+    if as_json:
+        print(json.dumps(values, indent=2))
+    else:
+        for name, value in values.items():
+            print('{}: {}'.format(name, value))
+
+
+def info(args):
+    photon = Photon(args.filepath, header_only=True)   # layer data is not read
+    values = {name: value for name, value in photon._header_values().items() if value is not None}  # no v2 values for v1
+    heights = photon.layer_table['height']
+    values['height_mm'] = float(heights.max()) + photon.layer_height if heights.size else 0.0
+    values['file_size'] = os.path.getsize(args.filepath)
+    _print_values(values, args.json)
+    return 0
+
+
+def extract(args):
+    with Photon(args.filepath, memory_map=True) as photon:    # only the selected layers get read
+        photon.export_images(args.dirpath, workers=args.workers, mode=args.mode, layers=args.layers)
+    return 0
+
+
+def pack(args):
+    # the anti-aliasing level is the one of the source, single images per layer get split into the levels of template
+    if os.path.isdir(args.source):
+        layers = layer_files(args.source)
+        levels = len(layers[0]) if layers and len(layers[0]) > 1 else None
+    else:
+        layers = np.load(args.source, mmap_mode='r')    # a volume (layers, [levels,] rows, columns) or a BitStack file
+        levels = layers.shape[1] if layers.ndim == 4 else None
+    if not len(layers):
+        raise ValueError('no layers found in {}'.format(args.source))
+    photon = Photon._from_template(args.template, levels)
+    if isinstance(layers, np.ndarray) and layers.ndim == 4 and layers.shape[-1] != photon.resolution_x:
+        layers = BitStack(args.source, photon.resolution_x)     # bit-packed by export_stack
+    with PhotonWriter(args.filepath, len(layers), photon, dedup=args.dedup) as writer:
+        writer.add_layers(layers, args.layer_thickness, args.exposure_time, args.off_time, args.workers, args.threshold)
+    return 0
+
+
+def set_values(args):
+    values = _assignments(args.values)
+    parameters = _assignments(args.layer_parameters)
+    photon = Photon(args.filepath, header_only=True)   # only the changed bytes get written
+    formats = header_fields(photon.version)
+    for name, value in values.items():
+        if name not in formats:
+            raise ValueError('{} can not be set, use one of {}'.format(name, ', '.join(formats)))
+        setattr(photon, name, field_value(name, value, formats[name]))
+    for name, value in parameters.items():
+        if name not in LayerParameters.columns:
+            raise ValueError('{} is not a layer parameter, use one of {}'.format(name, ', '.join(LayerParameters.columns)))
+        photon.set_layer_parameters(name, field_value(name, value, 'f'), args.layers)
+    photon.save_in_place()
+    return 0
+
+
+def stats(args):
+    with Photon(args.filepath, memory_map=True) as photon:
+        statistics = photon.statistics(workers=args.workers)
+    area = statistics['area_mm2']
+    bbox = statistics['bbox'][statistics['bbox'][:, 0] >= 0]
+    values = {
+        'layers': len(photon.layers),
+        'empty_layers': int((statistics['exposed_pixels'].sum(axis=1) == 0).sum()),
+        'volume_ml': statistics['volume_ml'],
+        'max_area_mm2': float(area.max()) if len(area) else 0.0,
+        'max_area_layer': int(area.argmax()) if len(area) else None,
+        'mean_area_mm2': float(area.mean()) if len(area) else 0.0,
+        'bbox': [int(bbox[:, 0].min()), int(bbox[:, 1].max()), int(bbox[:, 2].min()), int(bbox[:, 3].max())] if len(bbox) else None,
+    }
+    if args.per_layer:
+        values['area_mm2'] = area.tolist()
+    _print_values(values, args.json)
+    return 0
+
+
+def diff(args):
+    with Photon(args.a, memory_map=True) as a, Photon(args.b, memory_map=True) as b:
+        result = a.diff(b, workers=args.workers)
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        for name, (value_a, value_b) in result['header'].items():
+            print('header {}: {} -> {}'.format(name, value_a, value_b))
+        for idx in result['removed']:
+            print('removed layer {}'.format(idx))
+        for idx in result['added']:
+            print('added layer {}'.format(idx))
+        for idx_a, idx_b in result['changed']:
+            print('changed layer {} -> {}'.format(idx_a, idx_b))
+        for idx_a, idx_b, fields in result['parameters']:
+            changes = ', '.join('{}: {} -> {}'.format(name, values_a, values_b) for name, (values_a, values_b) in fields.items())
+            print('parameters of layer {} -> {}: {}'.format(idx_a, idx_b, changes))
+    return int(any(result.values()))  # like diff: 1 if the files differ
+
+
+def validate(args):
+    results = validate_files(args.filepaths, workers=args.workers)
+    for filepath, problems in results.items():
+        if not problems:
+            if args.verbose:
+                print('{}: ok'.format(filepath))
+            continue
+        print('{}:'.format(filepath))
+        for problem in problems:
+            print('    ' + problem)
+    return int(any(results.values()))   # 1 if any file has problems
+
+
+def _assignments(values):
+    """
+    Parses ['name=value', ...] to a dict, values are parsed as JSON if possible (numbers) and kept as string otherwise.
+    """
+    result = {}
+    for assignment in values or []:
+        name, sep, value = assignment.partition('=')
+        if not sep:
+            raise ValueError('expected name=value, got {}'.format(assignment))
+        try:
+            result[name] = json.loads(value)
+        except ValueError:
+            result[name] = value
+    return result
+
+
+def batch(args):
+    pipeline = []
+    if args.validate:
+        pipeline.append('validate')
+    if args.set:
+        pipeline.append(('set', _assignments(args.set)))
+    if args.layer_parameters:
+        pipeline.append(('layer_parameters', _assignments(args.layer_parameters)))
+    if args.print_properties:
+        pipeline.append(('print_properties', {'density': args.density}))
+    if args.preview:
+        pipeline.append('preview')
+    if args.output_dir or args.suffix or args.in_place:
+        pipeline.append(('write', {'dirpath': args.output_dir, 'suffix': args.suffix, 'dedup': args.dedup}))
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+
+    def progress(done, total, result):
+        status = 'failed' if result['error'] else 'ok'
+        print('[{}/{}] {}: {} ({:.1f} s)'.format(done, total, result['filepath'], status, result['seconds']), file=sys.stderr)
+
+    memory_limit = args.memory_limit * 2**20 if args.memory_limit else None
+    failed = 0
+    for result in batch_.run(args.filepaths, pipeline, args.workers, memory_limit, progress=None if args.quiet else progress):
+        if result['error']:
+            failed += 1
+            print('{}: {}'.format(result['filepath'], result['error'].strip().splitlines()[-1]))   # the exception of the traceback
+    return int(failed > 0)  # 1 if any file failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='pyphotonfile', description='Tools for Photon- and cbddlp-files.')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    parser_info = subparsers.add_parser('info', help='print the header values, only reads header and layer table')
+    parser_info.add_argument('filepath')
+    parser_info.add_argument('--json', action='store_true', help='print the values as JSON')
+    parser_info.set_defaults(func=info)
+
+    parser_extract = subparsers.add_parser('extract', help='export layer images')
+    parser_extract.add_argument('filepath')
+    parser_extract.add_argument('dirpath')
+    parser_extract.add_argument('--layers', type=_layers, default=None, help='layer selection like 5, 10:20 or ::2')
+    parser_extract.add_argument('--mode', choices=['1', 'L', 'RGB', 'npy'], default='1', help='image format, see Photon.export_image')
+    parser_extract.add_argument('--workers', type=int, default=None, help='number of processes')
+    parser_extract.set_defaults(func=extract)
+
+    parser_pack = subparsers.add_parser('pack', help='create a file from a directory of images or a .npy volume')
+    parser_pack.add_argument('source', help='directory with images named like 00000_00.png or .npy file')
+    parser_pack.add_argument('filepath')
+    parser_pack.add_argument('--template', help='file to take the header values from')
+    parser_pack.add_argument('--layer-thickness', type=float, default=None)
+    parser_pack.add_argument('--exposure-time', type=float, default=None)
+    parser_pack.add_argument('--off-time', type=float, default=None)
+    parser_pack.add_argument('--threshold', type=int, default=0, help='pixels brighter than this are exposed')
+    parser_pack.add_argument('--dedup', action='store_true', help='store identical layers only once')
+    parser_pack.add_argument('--workers', type=int, default=None, help='number of processes')
+    parser_pack.set_defaults(func=pack)
+
+    parser_set = subparsers.add_parser('set', help='patch header values and layer parameters in place')
+    parser_set.add_argument('filepath')
+    parser_set.add_argument('values', nargs='*', metavar='NAME=VALUE', help='header values, e.g. exposure_time=8')
+    parser_set.add_argument('--layer-parameters', nargs='+', metavar='NAME=VALUE', help='e.g. exposure_time=8')
+    parser_set.add_argument('--layers', type=_layers, default=slice(None), help='layers for --layer-parameters like 0:5')
+    parser_set.set_defaults(func=set_values)
+
+    parser_stats = subparsers.add_parser('stats', help='print statistics calculated from the layer data')
+    parser_stats.add_argument('filepath')
+    parser_stats.add_argument('--workers', type=int, default=None, help='number of processes')
+    parser_stats.add_argument('--per-layer', action='store_true', help='also print the area of each layer')
+    parser_stats.add_argument('--json', action='store_true', help='print the statistics as JSON')
+    parser_stats.set_defaults(func=stats)
+
+    parser_diff = subparsers.add_parser('diff', help='compare two files without decoding layer images')
+    parser_diff.add_argument('a')
+    parser_diff.add_argument('b')
+    parser_diff.add_argument('--workers', type=int, default=None, help='number of threads used for hashing layer data')
+    parser_diff.add_argument('--json', action='store_true', help='print the diff as JSON')
+    parser_diff.set_defaults(func=diff)
+
+    parser_validate = subparsers.add_parser('validate', help='check files for corrupt layer data and file structure')
+    parser_validate.add_argument('filepaths', nargs='+')
+    parser_validate.add_argument('--workers', type=int, default=None, help='number of processes')
+    parser_validate.add_argument('-v', '--verbose', action='store_true', help='also list files without problems')
+    parser_validate.set_defaults(func=validate)
+
+    parser_batch = subparsers.add_parser('batch', help='apply operations to many files in a pool of processes')
+    parser_batch.add_argument('filepaths', nargs='+')
+    parser_batch.add_argument('--validate', action='store_true', help='skip files with problems')
+    parser_batch.add_argument('--set', nargs='+', metavar='NAME=VALUE', help='header values, e.g. exposure_time=8')
+    parser_batch.add_argument('--layer-parameters', nargs='+', metavar='NAME=VALUE', help='parameters of all layers, e.g. exposure_time=8')
+    parser_batch.add_argument('--print-properties', action='store_true', help='update volume and weight from the layer data')
+    parser_batch.add_argument('--density', type=float, default=1.1, help='resin density in g/ml for --print-properties')
+    parser_batch.add_argument('--preview', action='store_true', help='render the previews from the layer data')
+    parser_batch.add_argument('--output-dir', help='write the files to this directory')
+    parser_batch.add_argument('--suffix', default='', help='write the files with this suffix added to the name')
+    parser_batch.add_argument('--in-place', action='store_true', help='save the files in place')
+    parser_batch.add_argument('--dedup', action='store_true', help='store identical layers only once')
+    parser_batch.add_argument('--workers', type=int, default=None, help='number of processes')
+    parser_batch.add_argument('--memory-limit', type=int, default=None, help='limit for the files processed at once in MB')
+    parser_batch.add_argument('-q', '--quiet', action='store_true', help='no progress output')
+    parser_batch.set_defaults(func=batch)
+
+    args = parser.parse_args(argv)
+    try:
+        return args.func(args)
+    except ValueError as e:
+        print('pyphotonfile {}: error: {}'.format(args.command, e), file=sys.stderr)
+        return 2
+
+
+if __name__ == '__main__':
+    sys.exit(main())
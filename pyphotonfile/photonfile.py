@@ -6,86 +6,936 @@ from PIL import Image
 import pkgutil
 import io
 import glob
+import mmap
+import shutil
+import concurrent.futures
+import collections
+import hashlib
+import difflib
+import contextlib
+import functools
+import inspect
+import json
+import time
+import tracemalloc
 
 # from IPython import embed
 
-def rle_to_imgarray(data):
+# layout of a single entry in the layer definition table
+LAYER_DEF_DTYPE = np.dtype([
+    ('height', '<f4'),
+    ('exposure_time', '<f4'),
+    ('off_time', '<f4'),
+    ('data_address', '<i4'),
+    ('data_length', '<i4'),
+    ('padding', 'V16'),
+])
+
+# number of pixels imgarr_to_rle processes at once
+ENCODE_CHUNKSIZE = 2**18
+
+# header fields with a fixed offset that can be patched in an existing file: attribute, offset, struct format. the
+# resolution is not one of them, the layer data depends on it
+HEADER_FIELDS = [
+    ('bed_x', 8, 'f'),
+    ('bed_y', 12, 'f'),
+    ('bed_z', 16, 'f'),
+    ('layer_height', 32, 'f'),
+    ('exposure_time', 36, 'f'),
+    ('exposure_time_bottom', 40, 'f'),
+    ('off_time', 44, 'f'),
+    ('bottom_layers', 48, 'i'),
+    ('projection_type', 80, 'i'),
+]
+HEADER_FIELDS_V2 = [
+    ('print_time', 76, 'i'),
+    ('light_pwm', 96, 'h'),
+    ('light_pwm_bottom', 98, 'h'),
+]
+# offsets relative to print_properties_address (version > 1 only)
+PRINT_PROPERTY_FIELDS = [
+    ('bottom_lift_distance', 0, 'f'),
+    ('bottom_lift_speed', 4, 'f'),
+    ('lifting_distance', 8, 'f'),
+    ('lifting_speed', 12, 'f'),
+    ('retract_speed', 16, 'f'),
+    ('volume_ml', 20, 'f'),
+    ('weight_g', 24, 'f'),
+    ('cost_dollars', 28, 'f'),
+    ('bottom_light_off_delay', 32, 'f'),
+    ('light_off_delay', 36, 'f'),
+    ('bottom_layer_count', 40, 'i'),
+    ('p1', 44, 'f'),
+    ('p2', 48, 'f'),
+    ('p3', 52, 'f'),
+    ('p4', 56, 'f'),
+]
+
+
+def header_fields(version):
+    """
+    Returns the header values and print properties that can be set in a file of version as dict name -> struct format.
+    """
+    fields = HEADER_FIELDS + (HEADER_FIELDS_V2 + PRINT_PROPERTY_FIELDS if version > 1 else [])
+    return {name: fmt for name, _, fmt in fields}
+
+
+def field_value(name, value, fmt):
+    """
+    Converts value to the type of a field with the struct format fmt: int for 'i' and 'h', float for 'f'. Raises
+    ValueError if it does not fit.
+    """
+    try:
+        if fmt == 'f':
+            value = float(value)
+        else:
+            if isinstance(value, float) and not value.is_integer():
+                raise ValueError
+            value = int(value)
+        struct.pack(fmt, value)
+    except (ValueError, TypeError, OverflowError, struct.error):
+        raise ValueError('invalid value {!r} for {}, expected {}'.format(value, name, 'a number' if fmt == 'f' else 'an integer'))
+    return value
+
+# the active Profiler of this process, None if profiling is off
+_profiler = None
+
+
+class Profiler:
+    """
+    Records the time, bytes and layers of the stages of opening, decoding, encoding, image I/O and writing files.
+    Profiles everything running within the with block in this process (not in worker processes):
+
+        with Profiler(trace_memory=True) as profiler:
+            photon = Photon(filepath)
+            photon.export_images('tempdir')
+        print(profiler.report())
+
+    Times of stages include the stages running within them, e.g. write.layers contains encode for images. With
+    trace_memory, the peak of the memory allocated (tracemalloc, including numpy) is recorded for the whole block
+    and each stage, which slows everything down considerably. callback(stage, seconds, nbytes, layers) gets called
+    for each recorded stage, e.g. to feed monitoring.
+    """
+    def __init__(self, trace_memory=False, callback=None):
+        self.trace_memory = trace_memory
+        self.callback = callback
+        self.stages = collections.OrderedDict()     # stage -> dict of calls, seconds, bytes, layers, peak_memory
+        self.seconds = 0.0
+        self.peak_memory = None
+        self._open_stages = []  # running stages with the highest memory peak seen while they run
+        self._previous = None
+        self._started_tracing = False
+        self._start = None
+
+    def __enter__(self):
+        global _profiler
+        self._previous = _profiler
+        _profiler = self
+        if self.trace_memory:
+            self._started_tracing = not tracemalloc.is_tracing()
+            if self._started_tracing:
+                tracemalloc.start()
+            self._base_memory = tracemalloc.get_traced_memory()[0]
+            self.peak_memory = 0
+            tracemalloc.reset_peak()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        global _profiler
+        self.seconds += time.perf_counter() - self._start
+        if self.trace_memory:
+            self.peak_memory = max(self.peak_memory, tracemalloc.get_traced_memory()[1] - self._base_memory)
+            if self._started_tracing:
+                tracemalloc.stop()
+        _profiler = self._previous
+
+    def begin(self, stage):
+        """
+        Starts a stage and returns a token for end. Use the stage context manager unless the stage can't be a block.
+        """
+        token = [stage, None, 0]
+        if self.trace_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            for running in self._open_stages:    # resetting the peak must not lose the peaks of running stages
+                running[2] = max(running[2], peak)
+            self.peak_memory = max(self.peak_memory, peak - self._base_memory)
+            tracemalloc.reset_peak()
+            token[2] = current
+            token.append(current)
+            self._open_stages.append(token)
+        token[1] = time.perf_counter()
+        return token
+
+    def end(self, token, nbytes=0, layers=0):
+        """
+        Ends the stage of token, recording nbytes read or written and layers processed.
+        """
+        seconds = time.perf_counter() - token[1]
+        stage = token[0]
+        record = self.stages.get(stage)
+        if record is None:
+            record = self.stages[stage] = {'calls': 0, 'seconds': 0.0, 'bytes': 0, 'layers': 0, 'peak_memory': None}
+        record['calls'] += 1
+        record['seconds'] += seconds
+        record['bytes'] += nbytes
+        record['layers'] += layers
+        if self.trace_memory:
+            self._open_stages.remove(token)
+            peak = max(token[2], tracemalloc.get_traced_memory()[1]) - token[3]
+            record['peak_memory'] = max(record['peak_memory'] or 0, peak)
+        if self.callback is not None:
+            self.callback(stage, seconds, nbytes, layers)
+
+    @contextlib.contextmanager
+    def stage(self, stage):
+        """
+        Context manager recording the block as stage. Yields a list [nbytes, layers] to be updated by the block.
+        """
+        counts = [0, 0]
+        token = self.begin(stage)
+        try:
+            yield counts
+        finally:
+            self.end(token, *counts)
+
+    def summary(self):
+        """
+        Returns the recorded stages and totals as dict, which can be serialized as JSON.
+        """
+        return {'seconds': self.seconds, 'peak_memory': self.peak_memory, 'stages': dict(self.stages)}
+
+    def report(self, format='text'):
+        """
+        Returns the summary as text table or with format='json' as JSON.
+        """
+        if format == 'json':
+            return json.dumps(self.summary(), indent=2)
+        if format != 'text':
+            raise ValueError("format must be 'text' or 'json'")
+        lines = ['{:<18} {:>8} {:>10} {:>10} {:>8} {:>10}'.format('stage', 'calls', 'seconds', 'MB', 'layers', 'peak MB')]
+        for stage, record in self.stages.items():
+            peak = '-' if record['peak_memory'] is None else '{:.1f}'.format(record['peak_memory'] / 2**20)
+            lines.append('{:<18} {:>8} {:>10.4f} {:>10.1f} {:>8} {:>10}'.format(
+                stage, record['calls'], record['seconds'], record['bytes'] / 2**20, record['layers'], peak))
+        total = 'total {:.4f} s'.format(self.seconds)
+        if self.peak_memory is not None:
+            total += ', peak memory {:.1f} MB'.format(self.peak_memory / 2**20)
+        lines.append(total)
+        return '\n'.join(lines)
+
+
+@contextlib.contextmanager
+def _stage(stage):
+    """
+    Records the block as stage of the active Profiler. Yields a list [nbytes, layers] to be updated by the block.
+    """
+    profiler = _profiler
+    if profiler is None:
+        yield [0, 0]
+        return
+    with profiler.stage(stage) as counts:
+        yield counts
+
+
+def _profiled(stage, measure=None):
+    """
+    Decorator recording calls of a hot function as stage of the active Profiler. measure(arguments, result) returns
+    (nbytes, layers) of a call, by default (0, 1). arguments maps the parameter names to the values of the call.
+    Errors of measure only lose the counts, the call itself is never affected. Costs a single check when profiling
+    is off.
+    """
+    def decorate(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            profiler = _profiler
+            if profiler is None:
+                return func(*args, **kwargs)
+            token = profiler.begin(stage)
+            try:
+                result = func(*args, **kwargs)
+            except BaseException:
+                profiler.end(token)
+                raise
+            counts = (0, 1)
+            if measure is not None:
+                try:
+                    counts = measure(signature.bind(*args, **kwargs).arguments, result)
+                except Exception:
+                    counts = (0, 0)
+            profiler.end(token, *counts)
+            return result
+        return wrapper
+    return decorate
+
+
+@_profiled('decode', lambda arguments, result: (len(arguments['data']), 1))
+def rle_to_imgarray(data, out=None, shape=(2560, 1440), dtype=np.uint8):
     """
-    Decodes a RLE byte array imgarray.
-    Based and honestly mostly copied from: https://github.com/Photonsters/PhotonFileEditor
+    Decodes a RLE byte array to an image array of the given shape (rows, columns) containing 1 for exposed and 0 for
+    dark pixels. If out is supplied, the image gets decoded into it, which allows reusing buffers when decoding many
+    layers. out has to be a C-contiguous array with the correct number of pixels. Raises ValueError if the runs do not add up
+    to the number of pixels.
+    Based on: https://github.com/Photonsters/PhotonFileEditor
     """
     # Encoding scheme:
     #     Highest bit of each byte is color (black or white)
     #     Lowest 7 bits of each byte is repetition of that color, with max of 125 / 0x7D
     data = np.frombuffer(data, dtype=np.uint8)
+    n = int(np.prod(shape) if out is None else out.size)
+    values = data >> 7  # highest bit is the color
+    lengths = data & 0x7f   # lowest 7 bits are the nr of repetitions
+    if lengths.sum(dtype=np.int64) != n:
+        raise ValueError('RLE data decodes to {} pixels but {} were expected'.format(lengths.sum(dtype=np.int64), n))
 
-    # Extract color value (highest bit) and nr of repetitions (lowest 7 bits)
-    valbin = data >> 7  # only read 1st bit
-    nr = data & ~(1 << 7)  # turn highest bit of
+    x = np.repeat(values, lengths)  # expands all runs in one pass
+    if out is None:
+        if np.dtype(dtype).itemsize == 1:
+            return x.view(dtype).reshape(shape)   # uint8 and bool need no copy
+        return x.astype(dtype).reshape(shape)
+    if not out.flags.c_contiguous:
+        raise ValueError('out has to be C-contiguous')
+    out.reshape(-1)[:] = x
+    return out
 
-    # Make a 2d array like [ [3,0] [2,1], [nr_i,val_i]...] using the colorvalues (val) and repetitions(nr)
-    runs = np.column_stack((nr, valbin))
 
-    # Decoding magic
-    runs_t = np.transpose(runs)
-    lengths = runs_t[0].astype(int)
-    values = runs_t[1].astype(int)
-    starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
-    starts, lengths, values = map(np.asarray, (starts, lengths, values))
-    ends = starts + lengths
-    n = ends[-1]
-    x = np.full(n, 0)
-    for lo, hi, val in zip(starts, ends, values):
-        x[lo:hi] = val
-    rgb2d = x.reshape((2560,1440))                # data is stored in rows of 2560
-    return rgb2d
+def rle_to_imgstack(payloads, out=None, shape=(2560, 1440), dtype=np.uint8):
+    """
+    Decodes multiple RLE byte arrays or SubLayers into a stack of images with the shape (len(payloads), rows, columns).
+    If out is supplied, the images get decoded into it. Useful to reuse a preallocated buffer for batches of layers.
+    """
+    if out is None:
+        out = np.empty((len(payloads),) + tuple(shape), dtype=dtype)
+    elif len(out) < len(payloads):
+        raise ValueError('out can only hold {} of {} images'.format(len(out), len(payloads)))
+    for i, payload in enumerate(payloads):
+        if isinstance(payload, SubLayer):
+            payload = payload._data
+        rle_to_imgarray(payload, out=out[i])
+    return out
 
 
-def imgarr_to_rle(imgarr):
+@_profiled('encode', lambda arguments, result: (len(result), 1))
+def imgarr_to_rle(imgarr, threshold=0, packed=False, columns=None):
     """
-    Converts image array to RLE encoded byte string.
+    Converts an image array of any resolution to RLE encoded bytes. Pixels with a value > threshold are exposed, so
+    grayscale images can be used with e.g. threshold=127. With packed, imgarr holds 8 pixels per byte as returned by
+    np.packbits along the rows, and columns is the width of the image (defaults to 8 times the packed width).
     Based on: https://github.com/Photonsters/PhotonFileEditor
     """
     # Encoding scheme:
     #     Highest bit of each byte is color (black or white)
     #     Lowest 7 bits of each byte is repetition of that color, with max of 125 / 0x7D
-    x = imgarr.flatten()
-    where = np.flatnonzero
-    x = np.asarray(x)
+    if packed:
+        imgarr = np.unpackbits(np.asarray(imgarr, dtype=np.uint8), axis=-1, count=columns).view(bool)
+    x = np.asarray(imgarr).reshape(-1)  # no copy for contiguous arrays, e.g. slices of a volume
     n = len(x)
     if n == 0:      # this should not happen if the image has the correct dimensions
-        return np.array([], dtype=np.int)
+        return b''
+
+    # color changes are searched in chunks, so that the temporary arrays stay small
+    changes = []
+    for first in range(0, n - 1, ENCODE_CHUNKSIZE):
+        segment = x[first:first + ENCODE_CHUNKSIZE + 1]
+        candidates = np.flatnonzero(segment[1:] != segment[:-1])
+        if segment.dtype != bool:   # only changes crossing the threshold count
+            candidates = candidates[(segment[candidates] > threshold) != (segment[candidates + 1] > threshold)]
+        changes.append(candidates + (first + 1))
+    starts = np.concatenate([[0]] + changes)  # start of color runs
+    lengths = np.diff(np.r_[starts, n])     # length of color runs
+    colors = (int(x[0] > threshold) + np.arange(len(starts))) % 2   # colors alternate
+    return _runs_to_rle(colors, lengths)
+
+
+@_profiled('encode', lambda arguments, result: (sum(len(payload) for payload in result), len(result)))
+def grayscale_to_rle(imgarr, levels):
+    """
+    Splits a grayscale image (uint8, 255 is fully exposed) into levels anti-aliasing sublayers and returns their RLE
+    data as list. Sublayer k is exposed where gray > k * 255 / levels. The pixels are only scanned once, the
+    sublayers get encoded from the runs of equal gray levels. bool images count as 0 and 255.
+    """
+    x = np.asarray(imgarr).reshape(-1)
+    if x.dtype == bool:
+        x = x.view(np.uint8) * np.uint8(255)
+    # number of exposed sublayers per gray value: gray > k * 255 / levels <=> k < ceil(gray * levels / 255)
+    counts = ((np.arange(256) * levels + 254) // 255).astype(np.uint8)
+    if len(x) == 0:
+        return [b''] * levels
+    starts = np.r_[0, np.flatnonzero(x[1:] != x[:-1]) + 1]
+    lengths = np.diff(np.r_[starts, len(x)])
+    exposed = counts[x[starts]]
+    payloads = []
+    for k in range(levels):
+        colors = (exposed > k).astype(np.int64)
+        new = np.r_[True, colors[1:] != colors[:-1]]    # neighbouring runs of the same color get merged
+        merged = np.bincount(np.cumsum(new) - 1, weights=lengths).astype(np.int64)
+        payloads.append(_runs_to_rle(colors[new], merged))
+    return payloads
+
+
+def rle_to_grayscale(payloads, shape=(2560, 1440)):
+    """
+    Composites the RLE data of the sublayers of an anti-aliasing layer to a grayscale image (uint8) with the gray
+    value count * 255 // levels for pixels exposed in count of the levels. Decodes all sublayers in one pass.
+    """
+    levels = len(payloads)
+    n = shape[0] * shape[1]
+    _, starts, stops = _exposed_runs(payloads)
+    # every run raises the number of exposed sublayers from its start to its stop
+    positions = np.concatenate([starts, stops])
+    order = np.argsort(positions, kind='stable')
+    exposed = np.cumsum(np.r_[np.ones(len(starts), dtype=np.int64), -np.ones(len(stops), dtype=np.int64)][order])
+    lengths = np.diff(np.r_[0, positions[order], n])
+    grays = (np.arange(levels + 1) * 255 // max(levels, 1)).astype(np.uint8)
+    return np.repeat(grays[np.r_[0, exposed]], lengths).reshape(shape)
 
-    starts = np.r_[0, where((x[1:] - x[:-1]).astype(bool)) + 1]  # start of color changes
-    lengths = np.diff(np.r_[starts, n])     # length of color run
-    colors = x[starts]  # color of each run
 
-    repetitions = lengths // 0x7d  # length of each run. calculated with integer division
-    run_ends = lengths % 0x7d  # remaining part of the run, calculated with mod
-    bin_colors = (colors > 0) << 7 | 0x7d   # convert colors to binary representation
-    repetitions[run_ends == 0] = repetitions[run_ends == 0] - 1   # 'fix' for 42 % 42 == 0. repetitions get used as np.insert indexes, and 0 means no insertion.
-    run_ends[run_ends == 0] = 0x7D   # again 'fix' for 42 % 42 == 0.
-    bin_run_ends = (colors > 0) << 7 | run_ends   # binary representation of last values in the run
+def _runs_to_rle(colors, lengths):
+    """
+    Encodes runs with colors (0 or 1) and lengths to RLE bytes. Runs are split into bytes of 125 pixels, the last
+    byte of a run holds the rest.
+    """
+    n_bytes = -(-lengths // 0x7d)
+    data = np.repeat((colors << 7 | 0x7d).astype(np.uint8), n_bytes)
+    data[np.cumsum(n_bytes) - 1] = colors << 7 | (lengths - 0x7d * (n_bytes - 1))
+    return data.tobytes()
+
+def preview_to_imgarray(data, shape):
+    """
+    Decodes the RLE encoded data of a preview image to an RGB image array of the given shape (rows, columns).
+    """
+    # Encoding scheme:
+    #     Every pixel color is a 16 bit little endian word with 5 bits for red, green and blue: RRRRRGGGGGXBBBBB
+    #     If X is set, the next word is a repetition word 0x3000 | (repetitions - 1)
+    words = np.frombuffer(data, dtype='<u2')
+    flags = (words & 0x20) != 0
+    # the first word of a stretch of flagged words always is a color. in the stretch colors and repetitions alternate.
+    # a word following a stretch is a repetition if the last word of the stretch was a color.
+    positions = np.arange(len(words))
+    stretch_starts = np.maximum.accumulate(np.where(flags & ~np.r_[False, flags[:-1]], positions, 0))
+    flagged_color = flags & ((positions - stretch_starts) % 2 == 0)
+    is_repetition = np.r_[False, flagged_color[:-1]]
+    colors = np.flatnonzero(~is_repetition)
+    repetition_positions = np.minimum(colors + 1, len(words) - 1)
+    counts = np.where(flagged_color[colors], (words[repetition_positions] & 0xfff).astype(np.int64) + 1, 1)
+    if counts.sum() != shape[0] * shape[1]:
+        raise ValueError('preview data decodes to {} pixels but {} were expected'.format(counts.sum(), shape[0] * shape[1]))
+    pixels = np.repeat(words[colors], counts)
+    imgarr = np.empty((len(pixels), 3), dtype=np.uint8)
+    imgarr[:, 0] = (pixels >> 11 & 0x1f) << 3
+    imgarr[:, 1] = (pixels >> 6 & 0x1f) << 3
+    imgarr[:, 2] = (pixels & 0x1f) << 3
+    return imgarr.reshape(tuple(shape) + (3,))
+
+
+def imgarray_to_preview(imgarr):
+    """
+    Encodes an RGB image array with the shape (rows, columns, 3) to the RLE format of preview images.
+    """
+    imgarr = np.asarray(imgarr, dtype=np.uint8)
+    x = ((imgarr[..., 0].astype(np.uint16) >> 3) << 11 | (imgarr[..., 1] >> 3).astype(np.uint16) << 6 | (imgarr[..., 2] >> 3)).ravel()
+    if len(x) == 0:
+        return b''
+    starts = np.r_[0, np.flatnonzero(x[1:] != x[:-1]) + 1]  # start of color changes
+    lengths = np.diff(np.r_[starts, len(x)])
+    # runs are split into chunks of up to 4095 pixels, the maximum of a repetition word
+    n_chunks = -(-lengths // 4095)
+    colors = np.repeat(x[starts], n_chunks)
+    counts = np.full(n_chunks.sum(), 4095, dtype=np.int64)
+    counts[np.cumsum(n_chunks) - 1] = lengths - 4095 * (n_chunks - 1)
+    # two pixels are written as two colors, longer chunks as flagged color and repetition word
+    two_words = counts > 1
+    repeated = counts > 2
+    positions = np.cumsum(1 + two_words) - 1 - two_words    # position of the color word of each chunk
+    data = np.empty(positions[-1] + 1 + two_words[-1], dtype='<u2')
+    data[positions] = colors | (repeated * 0x20).astype(np.uint16)
+    data[positions[two_words] + 1] = np.where(repeated[two_words], 0x3000 | (counts[two_words] - 1), colors[two_words])
+    return data.tobytes()
+
+
+def _exposed_runs(payloads):
+    """
+    Finds the runs of exposed pixels in RLE byte arrays without decoding them. Returns the arrays ids (index of the
+    payload), starts and stops (pixel positions within the image, stop exclusive) of all runs, sorted by payload and
+    position. Consecutive bytes of the same run get merged, as long runs are split in 125 pixels. The total number of
+    pixels of all payloads must fit into int32.
+    """
+    payload_starts = np.cumsum([0] + [len(payload) for payload in payloads])
+    data = np.frombuffer(b''.join(payloads), dtype=np.uint8)
+    lengths = data & 0x7f
+    ends = np.cumsum(lengths, dtype=np.int32)
+
+    lit = np.flatnonzero(data > 0x80)
+    ids = np.repeat(np.arange(len(payloads)), np.diff(np.searchsorted(lit, payload_starts)))
+    if not len(lit):
+        return ids, lit.astype(np.int32), lit.astype(np.int32)
+    breaks = np.flatnonzero((np.diff(lit) != 1) | (np.diff(ids) != 0)) + 1
+    first_bytes = lit[np.r_[0, breaks]]
+    last_bytes = lit[np.r_[breaks - 1, len(lit) - 1]]
+    ids = ids[np.r_[0, breaks]]
+    offsets = np.r_[0, ends][payload_starts[:-1]][ids]    # pixel position of the first byte of each payload
+    starts = ends[first_bytes] - lengths[first_bytes] - offsets
+    stops = ends[last_bytes] - offsets
+    return ids, starts, stops
+
+
+def rle_statistics(payloads, shape=(2560, 1440)):
+    """
+    Computes statistics of RLE byte arrays directly from the runs without decoding images. Returns a dict with the
+    arrays 'exposed_pixels' (number of exposed pixels per payload) and 'bbox' (row_min, row_max, column_min,
+    column_max of the exposed pixels per payload, -1 for payloads without exposed pixels).
+    """
+    width = shape[1]
+    exposed_pixels = np.zeros(len(payloads), dtype=np.int64)
+    bbox = np.full((len(payloads), 4), -1, dtype=np.int64)
+    chunksize = max(1, (2**31 - 1) // (shape[0] * width))   # keeps pixel positions within int32
+    for first in range(0, len(payloads), chunksize):
+        chunk = payloads[first:first + chunksize]
+        ids, starts, stops = _exposed_runs(chunk)
+        exposed_pixels[first:first + len(chunk)] = np.bincount(ids, weights=stops - starts, minlength=len(chunk))
+        if len(ids):
+            group_starts = np.flatnonzero(np.diff(ids, prepend=-1))  # runs are grouped by payload
+            group_ends = np.r_[group_starts[1:], len(ids)] - 1
+            groups = first + ids[group_starts]
+            start_rows, start_columns = np.divmod(starts, width)
+            last_rows, last_columns = np.divmod(stops - 1, width)
+            bbox[groups, 0] = start_rows[group_starts]
+            bbox[groups, 1] = last_rows[group_ends]
+            # runs wrapping into the next row touch the first and the last column
+            wraps = start_rows != last_rows
+            bbox[groups, 2] = np.minimum.reduceat(np.where(wraps, 0, start_columns), group_starts)
+            bbox[groups, 3] = np.maximum.reduceat(np.where(wraps, width - 1, last_columns), group_starts)
+    return {'exposed_pixels': exposed_pixels, 'bbox': bbox}
+
+
+def _rle_statistics(task):
+    """
+    rle_statistics for a task tuple (payloads, shape). Module level function, so that it can be used with process pools.
+    """
+    return rle_statistics(*task)
+
+
+def _exposure_boundaries(task):
+    """
+    Returns the starts and stops (pixel positions) of all exposed runs and the number of exposed pixels per payload
+    for a task tuple (payloads, shape). Module level function, so that it can be used with process pools.
+    """
+    payloads, shape = task
+    ids, starts, stops = _exposed_runs(payloads)
+    return starts, stops, np.bincount(ids, weights=stops - starts, minlength=len(payloads)).astype(np.int64)
+
+
+def rle_pixel_counts(payloads):
+    """
+    Returns the number of pixels encoded in each of the RLE byte arrays, summing the run lengths without decoding.
+    """
+    # summed on views of the payloads, joining them would copy all layer data of memory-mapped files
+    counts = [(np.frombuffer(payload, dtype=np.uint8) & 0x7f).sum(dtype=np.int64) for payload in payloads]
+    return np.array(counts, dtype=np.int64)
+
+
+def rle_to_intervals(data, shape=(2560, 1440)):
+    """
+    Returns the runs of exposed pixels of RLE data split at row ends as arrays rows, starts and stops (columns, stop
+    exclusive), sorted by row and column.
+    """
+    _, starts, stops = _exposed_runs([data])
+    width = shape[1]
+    first_rows = starts.astype(np.int64) // width
+    n = (stops.astype(np.int64) - 1) // width - first_rows + 1  # number of rows covered by each run
+    rows = np.repeat(first_rows, n) + np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)
+    offsets = rows * width
+    starts = np.maximum(np.repeat(starts, n) - offsets, 0)
+    stops = np.minimum(np.repeat(stops, n) - offsets, width)
+    return rows, starts, stops
+
+
+def intervals_to_rle(rows, starts, stops, shape=(2560, 1440)):
+    """
+    Encodes runs of exposed pixels (see rle_to_intervals) to RLE data. Runs must not overlap but may be in any order.
+    """
+    width = shape[1]
+    n = shape[0] * width
+    flat_starts = np.asarray(rows, dtype=np.int64) * width + starts
+    flat_stops = flat_starts + (np.asarray(stops) - starts)
+    order = np.argsort(flat_starts, kind='stable')
+    flat_starts, flat_stops = flat_starts[order], flat_stops[order]
+    # runs continuing in the next row are one run in the RLE data
+    boundaries = np.r_[0, np.column_stack([flat_starts, flat_stops]).ravel(), n]
+    lengths = np.diff(boundaries)   # dark, exposed, dark, ..., exposed, dark
+    colors = np.arange(len(lengths)) % 2
+    nonzero = lengths > 0
+    lengths, colors = lengths[nonzero], colors[nonzero]
+    if len(lengths) > 1:
+        starts_of_runs = np.r_[True, colors[1:] != colors[:-1]]
+        ids = np.cumsum(starts_of_runs) - 1
+        lengths = np.bincount(ids, weights=lengths).astype(np.int64)
+        colors = colors[starts_of_runs]
+    return _runs_to_rle(colors, lengths)
+
+
+def _region(rows, starts, stops, left, top, width, height):
+    """
+    Moves runs into the region with the given offset and size, dropping everything outside of it.
+    """
+    rows = rows - top
+    starts = np.maximum(starts - left, 0)
+    stops = np.minimum(stops - left, width)
+    keep = (rows >= 0) & (rows < height) & (starts < stops)
+    return rows[keep], starts[keep], stops[keep]
+
+
+def _union(rows, starts, stops, shape):
+    """
+    Merges overlapping runs. Returns the runs as flat pixel positions starts and stops, sorted.
+    """
+    flat_starts = rows * shape[1] + starts
+    flat_stops = rows * shape[1] + stops
+    order = np.argsort(flat_starts, kind='stable')
+    flat_starts, flat_stops = flat_starts[order], flat_stops[order]
+    if not len(flat_starts):
+        return flat_starts, flat_stops
+    max_stops = np.maximum.accumulate(flat_stops)
+    new = np.r_[True, flat_starts[1:] > max_stops[:-1]]
+    return flat_starts[new], max_stops[np.r_[new[1:], True]]
+
+
+def _layer_runs(payloads, shape):
+    """
+    Returns the runs of pixels exposed in any of the payloads (the sublayers of a layer) as rows, starts, stops,
+    sorted and without overlaps.
+    """
+    if len(payloads) == 1:
+        return rle_to_intervals(payloads[0], shape)
+    runs = [rle_to_intervals(data, shape) for data in payloads]
+    flat_starts, flat_stops = _union(*[np.concatenate(arrays) for arrays in zip(*runs)], shape)
+    # runs of the union may continue in the next row
+    return rle_to_intervals(intervals_to_rle(np.zeros_like(flat_starts), flat_starts, flat_stops, (1, shape[0] * shape[1])), shape)
+
+
+def _overlapping(rows, starts, stops, other_rows, other_starts, other_stops, width, offset=0):
+    """
+    For runs sorted by row and column, returns the ranges first, last (exclusive) of the other runs in row + offset
+    overlapping each run.
+    """
+    other_flat_starts = other_rows * width + other_starts
+    other_flat_stops = other_rows * width + other_stops
+    base = (rows + offset) * width
+    first = np.searchsorted(other_flat_stops, base + starts, side='right')
+    last = np.searchsorted(other_flat_starts, base + stops, side='left')
+    return first, np.maximum(first, last)
+
+
+def rle_components(rows, starts, stops, width, connectivity=4):
+    """
+    Labels the connected components of runs sorted by row and column (see rle_to_intervals). Runs in neighbouring rows
+    are connected if they overlap (connectivity=4) or also touch diagonally (connectivity=8). Returns an array with
+    the label of each run, labels are numbered from 0 by the first run of each component.
+    """
+    grow = 1 if connectivity == 8 else 0
+    first, last = _overlapping(rows, np.maximum(starts - grow, 0), np.minimum(stops + grow, width), rows, starts, stops, width, offset=1)
+    counts = last - first
+    a = np.repeat(np.arange(len(rows)), counts)
+    b = np.repeat(first - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+    # union-find on arrays: roots get hooked to the smaller root of each connection, then paths are compressed
+    parent = np.arange(len(rows))
+    while True:
+        root_a, root_b = parent[a], parent[b]
+        differ = root_a != root_b
+        if not differ.any():
+            break
+        np.minimum.at(parent, np.maximum(root_a, root_b)[differ], np.minimum(root_a, root_b)[differ])
+        while True:
+            grandparent = parent[parent]
+            if (grandparent == parent).all():
+                break
+            parent = grandparent
+    return np.unique(parent, return_inverse=True)[1]
 
-    data = np.repeat(bin_colors, repetitions)     # fill array with runs
-    data = np.insert(data, repetitions.cumsum(), bin_run_ends)   # insert the last elements of each run
-    rle_data = data.astype('uint8').tobytes()
-    return rle_data
 
-def image_to_imgarr(filepath):
+def _find_islands(task):
     """
-    Loads an image from disk and returns a numpy array. Raises ValueError if the image does not have the correct resolution of 1440x2560.
+    Finds the islands of the layers in a task tuple (layers, first, previous, shape, connectivity), where layers is a
+    list with the payloads of the sublayers of consecutive layers starting at index first and previous holds the
+    payloads of the layer before (or None). Module level function, so that it can be used with process pools.
     """
-    imgarr = Image.open(filepath).convert('L')
-    if not (imgarr.width, imgarr.height) == (1440, 2560):
-        raise ValueError("Your image dimensions are off and should be 1440x2560")
-    imgarr = np.array(imgarr)
-    return imgarr
+    layers, first, previous, shape, connectivity = task
+    width = shape[1]
+    islands = []
+    previous = _layer_runs(previous, shape) if previous is not None else None
+    for i, payloads in enumerate(layers):
+        runs = _layer_runs(payloads, shape)
+        if previous is not None and len(runs[0]):
+            rows, starts, stops = runs
+            labels = rle_components(rows, starts, stops, width, connectivity)
+            first_previous, last_previous = _overlapping(rows, starts, stops, *previous, width)
+            supported = np.bincount(labels, weights=last_previous - first_previous) > 0
+            lengths = stops - starts
+            area = np.bincount(labels, weights=lengths)
+            sum_rows = np.bincount(labels, weights=rows * lengths)
+            sum_columns = np.bincount(labels, weights=(starts + stops - 1) * lengths / 2)
+            for label in np.flatnonzero(~supported):
+                islands.append({'layer': first + i, 'area': int(area[label]),
+                                'centroid': (float(sum_rows[label] / area[label]), float(sum_columns[label] / area[label]))})
+        previous = runs
+    return islands
+
+
+def rle_crop(data, left, top, width, height, shape=(2560, 1440)):
+    """
+    Returns the RLE data of the region of the image with the given offset and size (width columns, height rows).
+    Parts of the region outside of the image are dark, so this pads as well.
+    """
+    rows, starts, stops = _region(*rle_to_intervals(data, shape), left, top, width, height)
+    return intervals_to_rle(rows, starts, stops, (height, width))
+
+
+def rle_translate(data, dx, dy, shape=(2560, 1440)):
+    """
+    Returns the RLE data of the image moved by dx columns and dy rows. Pixels moved out of the image get lost.
+    """
+    return rle_crop(data, -dx, -dy, shape[1], shape[0], shape)
+
+
+def rle_mirror(data, axis='x', shape=(2560, 1440)):
+    """
+    Returns the RLE data of the image mirrored along axis: 'x' swaps left and right, 'y' top and bottom.
+    """
+    rows, starts, stops = rle_to_intervals(data, shape)
+    if axis == 'x':
+        starts, stops = shape[1] - stops, shape[1] - starts
+    elif axis == 'y':
+        rows = shape[0] - 1 - rows
+    else:
+        raise ValueError("axis must be 'x' or 'y'")
+    return intervals_to_rle(rows, starts, stops, shape)
+
+
+def rle_invert(data):
+    """
+    Returns the RLE data with exposed and dark pixels swapped. Only the color bit of every byte changes.
+    """
+    return (np.frombuffer(data, dtype=np.uint8) ^ 0x80).tobytes()
+
+
+def rle_merge(data, other, dx=0, dy=0, shape=(2560, 1440), other_shape=None):
+    """
+    Returns the RLE data of the union of both images, with other moved by dx columns and dy rows. other_shape is the
+    shape of other, if it differs. Pixels of other outside of the image get lost.
+    """
+    if other_shape is None:
+        other_shape = shape
+    rows, starts, stops = rle_to_intervals(data, shape)
+    other_rows, other_starts, other_stops = _region(*rle_to_intervals(other, other_shape), -dx, -dy, shape[1], shape[0])
+    flat_starts, flat_stops = _union(np.r_[rows, other_rows], np.r_[starts, other_starts], np.r_[stops, other_stops], shape)
+    return intervals_to_rle(np.zeros_like(flat_starts), flat_starts, flat_stops, (1, shape[0] * shape[1]))
+
+
+def _rle_transform(task):
+    """
+    Applies an RLE transform to a task tuple (function, data, *args). Module level function, so that it can be used
+    with process pools.
+    """
+    return task[0](*task[1:])
+
+
+def _rle_transforms(tasks):
+    """
+    Applies _rle_transform to a list of task tuples and returns the results as list. Module level function, so that
+    it can be used with process pools.
+    """
+    return [_rle_transform(task) for task in tasks]
+
+
+@_profiled('image_read', lambda arguments, result: (result.nbytes, 1))
+def image_to_imgarr(filepath, shape=(2560, 1440)):
+    """
+    Loads an image from disk (or takes a PIL image) and returns a numpy array, bool for 1 bit images and uint8
+    otherwise. Raises ValueError if the image does not have the resolution shape (rows, columns).
+    """
+    img = filepath if isinstance(filepath, Image.Image) else Image.open(filepath)
+    if (img.height, img.width) != tuple(shape):
+        raise ValueError("Your image dimensions are off and should be {}x{}".format(shape[1], shape[0]))
+    if img.mode != '1':
+        img = img.convert('L')
+    return np.asarray(img)
+
+def _written_bytes(arguments, result):
+    """
+    Size of the file written by _export_image, for the Profiler. np.save appends .npy to paths without it.
+    """
+    _, _, filepath, mode = arguments['task']
+    if mode == 'npy' and not filepath.endswith('.npy'):
+        filepath += '.npy'
+    return os.path.getsize(filepath), 1
+
+
+@_profiled('image_write', _written_bytes)
+def _export_image(task):
+    """
+    Decodes and saves a single layer image. task is a tuple (data, shape, filepath, mode), see Photon.export_image.
+    Module level function, so that it can be used with process pools.
+    """
+    data, shape, filepath, mode = task
+    if mode == 'npy':
+        np.save(filepath, rle_to_imgarray(data, shape=shape))
+    elif mode == '1':
+        Image.fromarray(rle_to_imgarray(data, shape=shape, dtype=bool)).save(filepath)
+    elif mode in ('L', 'RGB'):
+        img = Image.fromarray(rle_to_imgarray(data, shape=shape) * 255)
+        if mode == 'RGB':
+            img = img.convert('RGB')
+        img.save(filepath)
+    else:
+        raise ValueError('unknown image mode {!r}'.format(mode))
+
+
+def layer_files(dirpath):
+    """
+    Returns the images in dirpath named like the ones written by Photon.export_images (00000_00.png, ...) as list with
+    a list of the files of each layer.
+    """
+    files = glob.glob(os.path.join(dirpath, "[0-9][0-9][0-9][0-9][0-9]_[0-9][0-9].png"))
+    files = sorted(files)
+    layers = []
+    last_file_id = ''
+    for filepath in files:
+        file_id = os.path.basename(filepath)[:5]
+        if file_id == last_file_id:
+            layers[-1].append(filepath)
+        else:
+            layers.append([filepath])
+            last_file_id = file_id
+    return layers
+
+
+def _encode_image(image, shape=(2560, 1440), threshold=0):
+    """
+    Returns the RLE encoded data of image, which can be a path, PIL image, numpy array or already rle encoded bytes.
+    Arrays need the resolution shape (rows, columns) or can be bit-packed uint8 arrays with the shape (rows,
+    columns / 8). Pixels > threshold are exposed, see imgarr_to_rle. Module level function, so that it can be used
+    with process pools.
+    """
+    if isinstance(image, (bytes, memoryview)):
+        return image
+    if isinstance(image, np.ndarray):
+        if image.shape == tuple(shape):
+            return imgarr_to_rle(image, threshold)
+        if image.dtype == np.uint8 and image.shape == (shape[0], -(-shape[1] // 8)):
+            return imgarr_to_rle(image, packed=True, columns=shape[1])
+        raise ValueError('image arrays must have the shape {}'.format(tuple(shape)))
+    return imgarr_to_rle(image_to_imgarr(image, shape), threshold)
+
+
+def _encode_layer(task):
+    """
+    Returns the RLE data of the sublayers of a layer for a task tuple (images, shape, levels, threshold). A single
+    image for multiple levels gets split as grayscale image (see grayscale_to_rle), in which case threshold is not
+    used. Module level function, so that it can be used with process pools.
+    """
+    images, shape, levels, threshold = task
+    if len(images) == 1 and levels > 1 and not isinstance(images[0], (bytes, memoryview)):
+        image = images[0]
+        if not isinstance(image, np.ndarray):
+            image = image_to_imgarr(image, shape)
+        elif image.shape != tuple(shape):
+            raise ValueError('image arrays must have the shape {}'.format(tuple(shape)))
+        return grayscale_to_rle(image, levels)
+    return [_encode_image(image, shape, threshold) for image in images]
+
+
+def _pack_layers(task):
+    """
+    Decodes the RLE data of a task tuple (filepath, first, payloads, shape) and writes the bit-packed images into the
+    stack at filepath, starting at layer first. payloads is a list with the data of the levels per layer. Module level
+    function, so that it can be used with process pools.
+    """
+    filepath, first, payloads, shape = task
+    stack = np.load(filepath, mmap_mode='r+')
+    image = np.empty(shape, dtype=bool)
+    for i, levels in enumerate(payloads):
+        for level, data in enumerate(levels):
+            stack[first + i, level] = np.packbits(rle_to_imgarray(data, out=image), axis=-1)
+    stack.flush()
+
+
+def _unpack_layers(task):
+    """
+    Returns the RLE data of the layers first to stop of the stack at filepath for a task tuple (filepath, first,
+    stop, columns) as list with the data of the levels per layer. Module level function, so that it can be used with
+    process pools.
+    """
+    filepath, first, stop, columns = task
+    stack = np.load(filepath, mmap_mode='r')
+    return [[imgarr_to_rle(packed, packed=True, columns=columns) for packed in layer] for layer in stack[first:stop]]
+
+
+def _map_parallel(func, iterable, workers=None, chunksize=None):
+    """
+    Maps func over iterable, using a pool of workers processes if workers > 1. Results keep the input order. func has
+    to be a module level function and the items need to be picklable when workers are used.
+    """
+    if workers is None or workers <= 1:
+        return map(func, iterable)
+    items = list(iterable)
+    if chunksize is None:
+        chunksize = max(1, len(items) // (workers * 4))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(func, items, chunksize=chunksize))
+
+
+def _imap_parallel(func, iterable, workers=None):
+    """
+    Like _map_parallel, but lazy: yields the results in order while at most 2 * workers tasks are pending, so that
+    only a few items have to be in memory at once.
+    """
+    if workers is None or workers <= 1:
+        yield from map(func, iterable)
+        return
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = collections.deque()
+        for item in iterable:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def _map_threads(func, iterable, workers=None):
+    """
+    Like _map_parallel but with threads, for functions releasing the GIL (e.g. hashlib on large buffers).
+    """
+    if workers is None or workers <= 1:
+        return list(map(func, iterable))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(func, iterable))
+
+
+def _table_heights(heights):
+    """
+    Rounds heights accumulated in float64 to the decimals stored in the layer table. Thicknesses are often float32
+    values like layer_height, without rounding their error shows up in the float32 heights (0.45000002 for 9 layers of
+    0.05 mm instead of 0.45).
+    """
+    return np.round(heights, 6)
+
+
+def payload_hash(data):
+    """
+    Returns the fingerprint of layer data (bytes-like) used for diffs and deduplication.
+    """
+    return hashlib.blake2b(data, digest_size=16).digest()
+
 
 class Layer:
     """
     Represents a layer with one (no anti-aliasing) or more SubLayers (anti-aliasing) in the Photon-file.
     """
+    __slots__ = ('sublayers',)
+
     def __init__(self):
         self.sublayers = []
 
@@ -105,19 +955,236 @@ class Layer:
             comparisons.append(a == b)
         return all(comparisons)
 
+    def to_grayscale(self, shape=None):
+        """
+        Returns the sublayers composited to one grayscale image, see rle_to_grayscale. shape defaults to the
+        resolution of the Photon-file of the layer.
+        """
+        if shape is None:
+            cache = self.sublayers[0]._cache if self.sublayers else None
+            shape = cache.shape if cache is not None else (2560, 1440)
+        return rle_to_grayscale([sublayer._data for sublayer in self.sublayers], shape)
+
     def __repr__(self):
         return 'Layer({})'.format(self.sublayers)
 
+class ImageCache:
+    """
+    Least recently used cache for decoded layer images, limited to max_bytes. hits and misses count the lookups.
+    """
+    def __init__(self, max_bytes=128 * 2**20, shape=(2560, 1440)):
+        self.max_bytes = max_bytes
+        self.shape = shape
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._images = collections.OrderedDict()    # id(sublayer) -> (sublayer, image). keeps sublayer alive so its id stays unique
+
+    def get(self, sublayer):
+        """
+        Returns the decoded image of sublayer, decoding and caching it if necessary.
+        """
+        key = id(sublayer)
+        if key in self._images:
+            self.hits += 1
+            self._images.move_to_end(key)
+            return self._images[key][1]
+        self.misses += 1
+        image = rle_to_imgarray(sublayer._data, shape=self.shape)
+        image.flags.writeable = False   # shared by everybody asking for this layer
+        self._images[key] = (sublayer, image)
+        self.nbytes += image.nbytes
+        while self.nbytes > self.max_bytes and self._images:
+            _, (_, evicted) = self._images.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+        return image
+
+    def invalidate(self, sublayer):
+        """
+        Removes the image of sublayer from the cache.
+        """
+        entry = self._images.pop(id(sublayer), None)
+        if entry is not None:
+            self.nbytes -= entry[1].nbytes
+
+    def clear(self):
+        """
+        Removes all images from the cache.
+        """
+        self._images.clear()
+        self.nbytes = 0
+
+    def __len__(self):
+        return len(self._images)
+
+    def __repr__(self):
+        return 'ImageCache(%r images, %r bytes, %r hits, %r misses)' % (len(self), self.nbytes, self.hits, self.misses)
+
+
+class LayerParameters:
+    """
+    Columnar storage of layer_thickness, exposure_time and off_time of all SubLayers of a Photon-file, so that they
+    can be modified for all layers at once. Every SubLayer owns a row of values. Rows of removed SubLayers are not
+    reused, as the SubLayers might still be in use somewhere else.
+    """
+    columns = ['layer_thickness', 'exposure_time', 'off_time']
+
+    def __init__(self):
+        self.values = np.zeros((0, 3))
+        self.size = 0
+
+    def allocate(self, n):
+        """
+        Reserves n rows and returns the first of them.
+        """
+        if self.size + n > len(self.values):
+            values = np.zeros((max(2 * len(self.values), self.size + n, 64), 3))
+            values[:self.size] = self.values[:self.size]
+            self.values = values
+        row = self.size
+        self.size += n
+        return row
+
+    def adopt(self, sublayer):
+        """
+        Moves the parameters of sublayer into a new row.
+        """
+        values = np.array([sublayer.layer_thickness, sublayer.exposure_time, sublayer.off_time], dtype=np.float64)
+        row = self.allocate(1)
+        self.values[row] = values
+        sublayer._parameters, sublayer._row, sublayer._values = self, row, None
+
+    def __repr__(self):
+        return 'LayerParameters(%r rows)' % self.size
+
+
+def _parameter(column):
+    """
+    Returns a property for a column of LayerParameters. Values live in the SubLayer until it gets adopted by one.
+    """
+    def getter(self):
+        if self._parameters is None:
+            return self._values[column]
+        return float(self._parameters.values[self._row, column])
+
+    def setter(self, value):
+        if self._parameters is None:
+            self._values[column] = value
+        else:
+            self._parameters.values[self._row, column] = value
+    return property(getter, setter)
+
+
+class BitStack:
+    """
+    Bit-packed stack of layer images in a .npy file (see Photon.export_stack), memory-mapped for random access. The
+    file holds a uint8 array with the shape (n_layers, layer_levels, rows, columns / 8), 8 pixels per byte. columns
+    defaults to 8 times the packed width and only needs to be given for resolutions not divisible by 8. Indexing
+    unpacks the selected layers to bool arrays, e.g. stack[10] has the shape (layer_levels, rows, columns) and the
+    slab stack[100:200, 0] the shape (100, rows, columns). Several processes can open the same stack.
+    """
+    def __init__(self, filepath, columns=None, mode='r'):
+        self.filepath = filepath
+        self.packed = np.load(filepath, mmap_mode=mode)
+        self.columns = self.packed.shape[-1] * 8 if columns is None else columns
+
+    @property
+    def shape(self):
+        return self.packed.shape[:-1] + (self.columns,)
+
+    def __len__(self):
+        return len(self.packed)
+
+    def __getitem__(self, key):
+        return np.unpackbits(self.packed[key], axis=-1, count=self.columns).view(bool)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __repr__(self):
+        return 'BitStack(%r, shape=%r)' % (self.filepath, self.shape)
+
+
 class SubLayer:
     """
-    Represents a single layer in the Photon-file.
+    Represents a single layer in the Photon-file. SubLayers of a Photon-file keep their parameters in its
+    LayerParameters.
     """
+    __slots__ = ('_parameters', '_row', '_values', '_cache', '_source', '_address', '_payload', '_data_length',
+                 '_origin', '_fingerprint')
+
+    layer_thickness = _parameter(0)
+    exposure_time = _parameter(1)   # currently ignored by firmware?
+    off_time = _parameter(2)
+
     def __init__(self, data, layer_thickness=None, exposure_time=None, off_time=None):
-        self.layer_thickness = layer_thickness
-        self.exposure_time = exposure_time  # currently ignored by firmware?
-        self.off_time = off_time
+        self._parameters = None
+        self._row = None
+        self._values = [layer_thickness, exposure_time, off_time]
+        self._cache = None
+        self._source = None
+        self._address = None
+        self._origin = None
+        self._fingerprint = None
         self._data = data
-        self._data_length = len(self._data)
+
+    @classmethod
+    def _from_source(cls, source, address, data_length, parameters, row):
+        """
+        Creates a SubLayer with the parameters in row of parameters, whose data gets sliced from source (e.g. a
+        memoryview of a memory-mapped file) on first access. A source of None means the data was never loaded
+        (header only).
+        """
+        sublayer = cls.__new__(cls)
+        sublayer._parameters = parameters
+        sublayer._row = row
+        sublayer._values = None
+        sublayer._cache = None
+        sublayer._source = source
+        sublayer._address = address
+        sublayer._payload = None
+        sublayer._data_length = data_length
+        sublayer._origin = None
+        sublayer._fingerprint = None
+        return sublayer
+
+    @property
+    def _data(self):
+        if self._payload is None:
+            if self._source is None:
+                raise ValueError('layer data is not loaded. open the file without header_only and keep it open to access it')
+            self._payload = self._source[self._address:self._address + self._data_length]
+        return self._payload
+
+    @_data.setter
+    def _data(self, data):
+        self._payload = data
+        self._source = None
+        self._origin = None # the data is not the one stored in the file anymore
+        self._fingerprint = None
+        self._data_length = len(data)
+        if self._cache is not None:
+            self._cache.invalidate(self)
+
+    @property
+    def fingerprint(self):
+        """
+        Hash of the layer data, see payload_hash. Gets cached until the data changes.
+        """
+        if self._fingerprint is None:
+            self._fingerprint = payload_hash(self._data)
+        return self._fingerprint
+
+    @property
+    def image(self):
+        """
+        Decoded image as read-only uint8 array with 1 for exposed pixels. Images of SubLayers belonging to a Photon
+        are kept in its image_cache.
+        """
+        if self._cache is None:
+            return rle_to_imgarray(self._data)
+        return self._cache.get(self)
 
     def __eq__(self, other):
         if not isinstance(other, SubLayer):
@@ -139,20 +1206,64 @@ class Photon:
     """
     Represents a Photon-file.
     """
-    def __init__(self, filepath=None):
+    def __init__(self, filepath=None, memory_map=False, header_only=False, image_cache_size=128 * 2**20):
+        """
+        Opens the Photon-file at filepath or creates a new one if filepath is None. With memory_map the file gets
+        memory-mapped and layer data is only sliced from the mapping (without copying) when it is accessed. With
+        header_only only the header, print properties and layer table are read, layer data is not accessible.
+        The layer table as stored in the file is available as structured array layer_table with the shape
+        (layer_levels, n_layers), e.g. layer_table['exposure_time']. It does not follow later modifications.
+        Decoded images accessed through SubLayer.image are kept in image_cache, using up to image_cache_size bytes.
+        """
+        self.image_cache = ImageCache(image_cache_size)
+        self._parameters = LayerParameters()
+        self._mmap = None
+        self._source = None
+        self.layers = []
+        self._filepath = filepath
+        self._origin = None
         if filepath is None:
             self._open()
             self.delete_layers()
         else:
-            self._open(filepath)
+            self._open(filepath, memory_map, header_only)
 
-    def _open(self, filepath=None):
+    @_profiled('open', lambda arguments, result: (0, len(arguments['self'].layers)))
+    def _open(self, filepath=None, memory_map=False, header_only=False):
+        source = None
+        data = None
         if filepath is None:
             data = pkgutil.get_data(__package__, 'newfile.photon')
+            f = io.BytesIO(data)
+        elif memory_map:
+            with open(filepath, 'rb') as fh:
+                self._mmap = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            f = self._mmap  # mmap objects support read, seek and tell
+            source = self._source = memoryview(self._mmap)
+        elif header_only:
+            f = open(filepath, 'rb')
         else:
-            with open(filepath, 'rb') as f:
-                data = f.read()
-        f = io.BytesIO(data)
+            with _stage('open.read') as counts, open(filepath, 'rb') as fh:
+                data = fh.read()
+                counts[0] = len(data)
+            f = io.BytesIO(data)
+        try:
+            self._read(f, source, data)
+        except BaseException:
+            self.close()
+            raise
+        finally:
+            if not memory_map:  # the mapping stays open until close, the layer data is read from it
+                f.close()
+        self.image_cache.shape = (self.resolution_y, self.resolution_x)
+        if filepath is not None:
+            self._snapshot(filepath, self.layer_table)
+
+    def _read(self, f, source, data):
+        """
+        Reads header, previews, print properties, layer table and layers from the file object f. Layer data gets
+        sliced from the bytes data or, if data is None, lazily from source (None for header only).
+        """
         self.header = f.read(4)
         self.version = struct.unpack('i', f.read(4))[0]
         self.bed_x = struct.unpack('f', f.read(4))[0]
@@ -220,252 +1331,890 @@ class Photon:
             self.p3 = struct.unpack('f', f.read(4))[0]
             self.p4 = struct.unpack('f', f.read(4))[0]
 
-        f.seek(self.layer_def_address, os.SEEK_SET)
-        self.layers = []
-        sublayers = []
-        for level in range(self.layer_levels):
-            sublayers.append([])
-            for i in range(self.n_layers):
-                layer_height = struct.unpack('f', f.read(4))[0]
-                try:
-                    layer_thickness = layer_height - previous_layer_height
-                except UnboundLocalError:
-                    layer_thickness = self.layer_height
-                    previous_layer_height = layer_thickness
-                previous_layer_height = layer_height
-                exposure_time = struct.unpack('f', f.read(4))[0]
-                off_time = struct.unpack('f', f.read(4))[0]
-                address = struct.unpack('i', f.read(4))[0]
-                data_length = struct.unpack('i', f.read(4))[0]
-                f.seek(4*4, os.SEEK_CUR)    # padding
-                curpos = f.tell()
-                f.seek(address, os.SEEK_SET)
-                data = f.read(data_length)
-                sublayers[-1].append(SubLayer(data, layer_thickness, exposure_time, off_time))
-                f.seek(curpos, os.SEEK_SET)
-            del previous_layer_height   # dirty hack to rest thickness calculation for multiple levels / anti aliasing. does anyone actually need the thickness?
-        f.close()
-        for i in range(self.n_layers):  # create layer objects with sorted sublayers for easier manipulation. could be done more elegantly.
-            layer = Layer()
-            for level in range(self.layer_levels):
-                layer.append_sublayer(sublayers[level][i])
-            self.layers.append(layer)
+        # the layer table is read in one go. it is sorted: Layer 1 Sublayer 1, L2 S1, L3 S1, ... L1 S4, L2 S4
+        with _stage('open.layer_table') as counts:
+            f.seek(self.layer_def_address, os.SEEK_SET)
+            table_length = self.n_layers * self.layer_levels * LAYER_DEF_DTYPE.itemsize
+            self.layer_table = np.frombuffer(f.read(table_length), dtype=LAYER_DEF_DTYPE).reshape(self.layer_levels, self.n_layers)
+            heights = self.layer_table['height'].astype(np.float64)
+            thicknesses = np.empty_like(heights)
+            thicknesses[:, 0:1] = self.layer_height  # does anyone actually need the thickness?
+            thicknesses[:, 1:] = np.diff(heights, axis=1)
+            parameters = np.stack([thicknesses, self.layer_table['exposure_time'], self.layer_table['off_time']], axis=-1)
+            n_sublayers = self.n_layers * self.layer_levels
+            start = self._parameters.allocate(n_sublayers)
+            self._parameters.values[start:start + n_sublayers] = parameters.transpose(1, 0, 2).reshape(-1, 3)  # sorted like the layers
+            counts[0] = table_length
+        addresses = self.layer_table['data_address'].tolist()
+        data_lengths = self.layer_table['data_length'].tolist()
+
+        with _stage('open.layers') as counts:
+            self.layers = []
+            payloads = {}   # table entries pointing to the same data share one buffer
+            for i in range(self.n_layers):  # create layer objects with sorted sublayers for easier manipulation
+                layer = Layer()
+                for level in range(self.layer_levels):
+                    address = addresses[level][i]
+                    data_length = data_lengths[level][i]
+                    sublayer = SubLayer._from_source(source, address, data_length, self._parameters, start)
+                    start += 1
+                    if data is not None:
+                        payload = payloads.get((address, data_length))
+                        if payload is None:
+                            payload = payloads[(address, data_length)] = data[address:address + data_length]
+                            counts[0] += data_length    # bytes copied from the file
+                        sublayer._payload = payload
+                    layer.append_sublayer(sublayer)
+                self._attach(layer)
+                self.layers.append(layer)
+            counts[1] = len(self.layers)
+
+    def close(self):
+        """
+        Releases the memory-mapped file of a Photon-file opened with memory_map. Layer data still read from the
+        mapping is not accessible afterwards, modified layers are kept. Does nothing for other Photon-files.
+        """
+        if self._mmap is None:
+            return
+        for layer in self.layers:
+            for sublayer in layer.sublayers:
+                if sublayer._source is self._source:
+                    sublayer._payload = None
+                    sublayer._source = None
+        self._source.release()
+        try:
+            self._mmap.close()
+        except BufferError:     # slices of layer data are still referenced elsewhere, the mapping closes with them
+            pass
+        self._mmap = None
+        self._source = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _attach(self, layer):
+        """
+        Lets the sublayers of layer use the image cache and layer parameters of this Photon-file.
+        """
+        for sublayer in layer.sublayers:
+            sublayer._cache = self.image_cache
+            if sublayer._parameters is not self._parameters:
+                self._parameters.adopt(sublayer)
+
+    def _rows(self):
+        """
+        Returns the rows of all sublayers in the layer parameters with the shape (n_layers, layer_levels). Sublayers
+        added to the layers directly get adopted.
+        """
+        rows = []
+        for layer in self.layers:
+            for sublayer in layer.sublayers:
+                if sublayer._parameters is not self._parameters:
+                    self._parameters.adopt(sublayer)
+                rows.append(sublayer._row)
+        return np.array(rows, dtype=np.intp).reshape(len(self.layers), self.layer_levels)
+
+    def get_layer_parameters(self, name):
+        """
+        Returns a copy of the layer parameter name (layer_thickness, exposure_time or off_time) of all sublayers as
+        array with the shape (n_layers, layer_levels).
+        """
+        return self._parameters.values[self._rows(), LayerParameters.columns.index(name)]
+
+    def set_layer_parameters(self, name, values, layers=slice(None)):
+        """
+        Sets the layer parameter name (layer_thickness, exposure_time or off_time) of the layers selected by layers
+        (index, slice, list or mask) at once. values is broadcast to the selected layers and their levels, so a single
+        value or one value per layer also works. E.g. a ramp for the bottom exposure:
+            photon.set_layer_parameters('exposure_time', np.linspace(60, 10, 8), slice(0, 8))
+        """
+        rows = self._rows()[layers]
+        values = np.asarray(values, dtype=np.float64)
+        if values.ndim == 1 and rows.ndim == 2:
+            values = values[:, None]    # one value per layer
+        self._parameters.values[rows, LayerParameters.columns.index(name)] = values
+
+    def _fields(self):
+        """
+        Returns the patchable header and print property fields as dict of name -> (address, packed bytes).
+        """
+        fields = HEADER_FIELDS
+        if self.version > 1:
+            fields = fields + HEADER_FIELDS_V2
+        fields = {name: (offset, fmt) for name, offset, fmt in fields}
+        if self.version > 1:
+            for name, offset, fmt in PRINT_PROPERTY_FIELDS:
+                fields[name] = (self.print_properties_address + offset, fmt)
+        return {name: (address, struct.pack(fmt, getattr(self, name))) for name, (address, fmt) in fields.items()}
+
+    def _structure(self):
+        """
+        Returns everything that can't be patched in place. If any of it changes, the file has to be rewritten.
+        """
+        structure = [self.header, self.version, self.layer_levels, len(self.layers), self.resolution_x, self.resolution_y,
+                     self.preview_highres_resolution_x, self.preview_highres_resolution_y, self.preview_highres_data,
+                     self.preview_lowres_resolution_x, self.preview_lowres_resolution_y, self.preview_lowres_data]
+        if self.version > 1:
+            structure += [self.anti_aliasing_level, self.print_properties_length]
+        return structure
+
+    def _snapshot(self, filepath, table):
+        """
+        Remembers the state of the file at filepath with the layer table table, so that later modifications can be
+        patched in place by save_in_place.
+        """
+        self._origin = {
+            'filepath': filepath,
+            'structure': self._structure(),
+            'fields': self._fields(),
+            'table': table.copy(),
+        }
+        addresses = table['data_address'].T.tolist()
+        data_lengths = table['data_length'].T.tolist()
+        for i, layer in enumerate(self.layers):
+            for level, sublayer in enumerate(layer.sublayers):
+                sublayer._origin = (self._origin, addresses[i][level], data_lengths[i][level])
 
+    def _thicknesses(self):
+        return self.get_layer_parameters('layer_thickness').T
 
-    def write(self, filepath):
+    @_profiled('write', lambda arguments, result: (os.path.getsize(arguments['filepath']), len(arguments['self'].layers)))
+    def write(self, filepath, dedup=False):
         """
-        Writes the Photon-file to disk.
+        Writes the Photon-file to disk. With dedup, identical layer data is only stored once and shared by all layers
+        using it, which makes files with many identical layers smaller.
+        """
+        # replacing a memory-mapped source file would pull the layer data from under our feet on some systems
+        same_file = self._mmap is not None and os.path.exists(filepath) and os.path.samefile(filepath, self._filepath)
+        for layer in self.layers:
+            if len(layer.sublayers) != self.layer_levels:
+                raise ValueError('number of sublayers must equal to number of levels in file')
+        for layer in self.layers:
+            for sublayer in layer.sublayers:
+                data = sublayer._data   # fails before anything gets overwritten if the data was never loaded
+                if same_file and isinstance(data, memoryview):
+                    with _stage('write.copy') as counts:
+                        sublayer._data = bytes(data)
+                        counts[0] = len(data)
+
+        with PhotonWriter(filepath, len(self.layers), self, dedup) as writer:
+            for layer in self.layers:
+                writer.add_layer(layer)
+        for name, address in writer.addresses.items():  # the addresses are the ones of the written file now
+            setattr(self, name, address)
+        self._snapshot(filepath, writer._table)
+
+    def save_in_place(self):
+        """
+        Saves the modifications to the file the Photon-file was read from or last written to. If only header values,
+        print properties or layer parameters changed, just the modified bytes get written. Otherwise (new, removed or
+        modified layer data, previews, anti-aliasing level, ...) the file gets rewritten completely. Returns True if
+        the file was patched in place and False if it was rewritten. Files opened with header_only can only be patched.
+        """
+        if self._origin is None:
+            raise ValueError('the Photon-file was not read from or written to a file yet')
+        origin = self._origin
+        table = self._patched_table() if self._structure() == origin['structure'] else None
+        if table is None:
+            self.write(origin['filepath'])
+            return False
+
+        patches = []
+        fields = self._fields()
+        for name, (address, value) in fields.items():
+            if origin['fields'][name] != value:
+                patches.append((address, value))
+        # dirty records of the table get written in contiguous runs
+        dirty = np.flatnonzero(table.ravel() != origin['table'].ravel())
+        if len(dirty):
+            splits = np.flatnonzero(np.diff(dirty) > 1) + 1
+            for run in np.split(dirty, splits):
+                start, stop = run[0], run[-1] + 1
+                patches.append((self.layer_def_address + start * LAYER_DEF_DTYPE.itemsize, table.ravel()[start:stop].tobytes()))
+        if patches:
+            with _stage('patch') as counts, open(origin['filepath'], 'r+b') as f:
+                for address, data in patches:
+                    f.seek(address)
+                    f.write(data)
+                    counts[0] += len(data)
+        origin['fields'] = fields
+        origin['table'] = table
+        return True
+
+    def _patched_table(self):
+        """
+        Returns the layer table for the current layers if all layer data is still stored in the file of the last
+        snapshot, otherwise None. Heights are accumulated from the thicknesses like PhotonWriter does.
+        """
+        origin = self._origin
+        table = origin['table'].copy()
+        locations = []
+        for layer in self.layers:
+            for sublayer in layer.sublayers:
+                if sublayer._origin is None or sublayer._origin[0] is not origin:
+                    return None
+                locations.append(sublayer._origin[1:])
+        locations = np.array(locations, dtype=np.int64).reshape(len(self.layers), self.layer_levels, 2)
+        table['data_address'] = locations[:, :, 0].T
+        table['data_length'] = locations[:, :, 1].T
+        table['exposure_time'] = self.get_layer_parameters('exposure_time').T
+        table['off_time'] = self.get_layer_parameters('off_time').T
+        thicknesses = self._thicknesses()
+        thicknesses[:, 0] = 0   # the first thickness is ignored
+        table['height'] = _table_heights(np.cumsum(thicknesses, axis=1))  # in float64, the stored float32 heights would drift
+        return table
+
+    def _header_bytes(self, n_layers):
+        """
+        Returns everything in front of the layer table (header, previews and print properties) for a file with
+        n_layers layers and the addresses of its parts as dict.
         """
         offsets = {}
         addresses = {}
 
-        with open(filepath, 'wb') as f:
-            f.write(self.header)
-            f.write(struct.pack('i', self.version))
-            f.write(struct.pack('f', self.bed_x))
-            f.write(struct.pack('f', self.bed_y))
-            f.write(struct.pack('f', self.bed_z))
-            f.write(b'\x00' * 3 * 4)  # padding
-            f.write(struct.pack('f', self.layer_height))
-            f.write(struct.pack('f', self.exposure_time))
-            f.write(struct.pack('f', self.exposure_time_bottom))
-            f.write(struct.pack('f', self.off_time))
-            f.write(struct.pack('i', self.bottom_layers))
-            f.write(struct.pack('i', self.resolution_x))
-            f.write(struct.pack('i', self.resolution_y))
-            f.write(struct.pack('i', self.preview_highres_header_address))
-            offsets['layer_def_address'] = f.tell()     # remember position in file to later add the correct address
-            f.write(struct.pack('i', 0x0 ))
-            f.write(struct.pack('i', len(self.layers)))
-            offsets['preview_lowres_header_address'] = f.tell() # remember position in file to later add the correct address
-            f.write(struct.pack('i', 0x0 ))
-
-            if self.version > 1:
-                f.write(struct.pack('i', self.print_time))
-            else:
-                f.write(b'\x00' * 4)  # padding
-            f.write(struct.pack('i', self.projection_type))
-            if self.version > 1:
-                offsets['print_properties_address'] = f.tell()  # remember position in file to later add the correct address
-                f.write(struct.pack('i', 0x0))
-                f.write(struct.pack('i', self.print_properties_length))
-                f.write(struct.pack('i', self.anti_aliasing_level))
-                f.write(struct.pack('h', self.light_pwm))
-                f.write(struct.pack('h', self.light_pwm_bottom))
-                f.write(b'\x00' * 3 * 4)
-            else:
-                f.write(b'\x00' * 6 * 4)  # padding
-            f.write(struct.pack('i', self.preview_highres_resolution_x))
-            f.write(struct.pack('i', self.preview_highres_resolution_y))
-            f.write(struct.pack('i', self.preview_highres_data_address))
-            f.write(struct.pack('i', self.preview_highres_data_length))
-            f.write(b'\x00' * 4 * 4)
-            f.write(self.preview_highres_data)
-            addresses['preview_lowres_header_address'] = f.tell()   # remember position in file to later add the correct address
-            f.write(struct.pack('i', self.preview_lowres_resolution_x))
-            f.write(struct.pack('i', self.preview_lowres_resolution_y))
-            f.write(struct.pack('i', self.preview_lowres_data_address))
-            f.write(struct.pack('i', self.preview_lowres_data_length))
-            f.write(b'\x00' * 4 * 4)
-            f.write(self.preview_lowres_data)
-            if self.version > 1:
-                addresses['print_properties_address'] = f.tell()    # remember position in file to later add the correct address
-                f.write(struct.pack('f', self.bottom_lift_distance))
-                f.write(struct.pack('f', self.bottom_lift_speed))
-                f.write(struct.pack('f', self.lifting_distance))
-                f.write(struct.pack('f', self.lifting_speed))
-                f.write(struct.pack('f', self.retract_speed))
-                f.write(struct.pack('f', self.volume_ml))
-                f.write(struct.pack('f', self.weight_g))
-                f.write(struct.pack('f', self.cost_dollars))
-                f.write(struct.pack('f', self.bottom_light_off_delay))
-                f.write(struct.pack('f', self.light_off_delay))
-                f.write(struct.pack('i', self.bottom_layer_count))
-                f.write(struct.pack('f', self.p1))
-                f.write(struct.pack('f', self.p2))
-                f.write(struct.pack('f', self.p3))
-                f.write(struct.pack('f', self.p4))
-
-            addresses['layer_def_address'] = f.tell()   # remember position in file to later add the correct address
-
-            layer_data_pos = f.tell() + len(self.layers) * self.layer_levels * (9 * 4)
-            layer_data_offsets = {}
-            layer_data_addresses = {}
-            for i, level in enumerate(range(self.layer_levels)):    # layers in header are sorted: Layer 1 Sublayer 1, L2 S1, L3 S1, ... L1 S4, L2 S4
-                layer_data_offsets[i] = {}
-                for j, layer in enumerate(self.layers):
-                    layer = layer.sublayers[level]
-                    try:
-                        f.write(struct.pack('f', layer.layer_thickness + previous_layer_height))
-                        previous_layer_height += layer.layer_thickness
-                    except UnboundLocalError:
-                        f.write(struct.pack('f', 0.0))
-                        previous_layer_height = 0
-                    f.write(struct.pack('f', layer.exposure_time))
-                    f.write(struct.pack('f', layer.off_time))
-                    layer_data_offsets[i][j] = f.tell() # remember position in file to later add the correct address
-                    f.write(struct.pack('i', 0x0))
-                    f.write(struct.pack('i', len(layer._data)))
-                    f.write(b'\x00' * 4 * 4)
-                del previous_layer_height   # dirty hack to rest thickness calculation for multiple levels / anti aliasing. does anyone actually need the thickness?
-            for j, layer in enumerate(self.layers):  # layers in data are sorted: Layer 1 Sublayer 1, L1 S2, L1 S3, ... LX S1, LX S2. Different than in the header!
-                for i, sublayer in enumerate(layer.sublayers):
-                    try:
-                        layer_data_addresses[i][j] = f.tell()
-                    except KeyError:
-                        layer_data_addresses[i] = {}
-                        layer_data_addresses[i][j] = f.tell()
-                    f.write(sublayer._data)
-
-            # update addresses
-            # header
-            for key, value in offsets.items():
-                f.seek(value)
-                f.write(struct.pack('i', addresses[key]))
-            # layers
-            for level, value in layer_data_offsets.items():
-                for layer, address in layer_data_addresses[level].items():
-                    f.seek(layer_data_offsets[level][layer])
-                    f.write(struct.pack('i', layer_data_addresses[level][layer]))
-
-    def export_images(self, dirpath):
-        """
-        Exports all containing layer images to a supplied directory.
+        f = io.BytesIO()
+        f.write(self.header)
+        f.write(struct.pack('i', self.version))
+        f.write(struct.pack('f', self.bed_x))
+        f.write(struct.pack('f', self.bed_y))
+        f.write(struct.pack('f', self.bed_z))
+        f.write(b'\x00' * 3 * 4)  # padding
+        f.write(struct.pack('f', self.layer_height))
+        f.write(struct.pack('f', self.exposure_time))
+        f.write(struct.pack('f', self.exposure_time_bottom))
+        f.write(struct.pack('f', self.off_time))
+        f.write(struct.pack('i', self.bottom_layers))
+        f.write(struct.pack('i', self.resolution_x))
+        f.write(struct.pack('i', self.resolution_y))
+        offsets['preview_highres_header_address'] = f.tell()    # remember position in file to later add the correct address
+        f.write(struct.pack('i', 0x0))
+        offsets['layer_def_address'] = f.tell()     # remember position in file to later add the correct address
+        f.write(struct.pack('i', 0x0 ))
+        f.write(struct.pack('i', n_layers))
+        offsets['preview_lowres_header_address'] = f.tell() # remember position in file to later add the correct address
+        f.write(struct.pack('i', 0x0 ))
+
+        if self.version > 1:
+            f.write(struct.pack('i', self.print_time))
+        else:
+            f.write(b'\x00' * 4)  # padding
+        f.write(struct.pack('i', self.projection_type))
+        if self.version > 1:
+            offsets['print_properties_address'] = f.tell()  # remember position in file to later add the correct address
+            f.write(struct.pack('i', 0x0))
+            f.write(struct.pack('i', self.print_properties_length))
+            f.write(struct.pack('i', self.anti_aliasing_level))
+            f.write(struct.pack('h', self.light_pwm))
+            f.write(struct.pack('h', self.light_pwm_bottom))
+            f.write(b'\x00' * 3 * 4)
+        else:
+            f.write(b'\x00' * 6 * 4)  # padding
+        addresses['preview_highres_header_address'] = f.tell()
+        f.write(struct.pack('i', self.preview_highres_resolution_x))
+        f.write(struct.pack('i', self.preview_highres_resolution_y))
+        f.write(struct.pack('i', addresses['preview_highres_header_address'] + 8 * 4))  # data follows the preview header
+        f.write(struct.pack('i', len(self.preview_highres_data)))
+        f.write(b'\x00' * 4 * 4)
+        f.write(self.preview_highres_data)
+        addresses['preview_lowres_header_address'] = f.tell()   # remember position in file to later add the correct address
+        f.write(struct.pack('i', self.preview_lowres_resolution_x))
+        f.write(struct.pack('i', self.preview_lowres_resolution_y))
+        f.write(struct.pack('i', addresses['preview_lowres_header_address'] + 8 * 4))
+        f.write(struct.pack('i', len(self.preview_lowres_data)))
+        f.write(b'\x00' * 4 * 4)
+        f.write(self.preview_lowres_data)
+        if self.version > 1:
+            addresses['print_properties_address'] = f.tell()    # remember position in file to later add the correct address
+            f.write(struct.pack('f', self.bottom_lift_distance))
+            f.write(struct.pack('f', self.bottom_lift_speed))
+            f.write(struct.pack('f', self.lifting_distance))
+            f.write(struct.pack('f', self.lifting_speed))
+            f.write(struct.pack('f', self.retract_speed))
+            f.write(struct.pack('f', self.volume_ml))
+            f.write(struct.pack('f', self.weight_g))
+            f.write(struct.pack('f', self.cost_dollars))
+            f.write(struct.pack('f', self.bottom_light_off_delay))
+            f.write(struct.pack('f', self.light_off_delay))
+            f.write(struct.pack('i', self.bottom_layer_count))
+            f.write(struct.pack('f', self.p1))
+            f.write(struct.pack('f', self.p2))
+            f.write(struct.pack('f', self.p3))
+            f.write(struct.pack('f', self.p4))
+
+        addresses['layer_def_address'] = f.tell()
+
+        # update addresses
+        for key, value in offsets.items():
+            f.seek(value)
+            f.write(struct.pack('i', addresses[key]))
+        return f.getvalue(), addresses
+
+    def get_preview(self, which='highres', as_image=False):
+        """
+        Returns the decoded 'highres' or 'lowres' preview image as RGB array with the shape (rows, columns, 3) or
+        as PIL image if as_image is set.
+        """
+        if which not in ('highres', 'lowres'):
+            raise ValueError("which must be 'highres' or 'lowres'")
+        shape = (getattr(self, 'preview_{}_resolution_y'.format(which)), getattr(self, 'preview_{}_resolution_x'.format(which)))
+        imgarr = preview_to_imgarray(getattr(self, 'preview_{}_data'.format(which)), shape)
+        if as_image:
+            return Image.fromarray(imgarr)
+        return imgarr
+
+    def set_preview(self, image, which='highres'):
+        """
+        Replaces the 'highres' or 'lowres' preview image. image can be a path, PIL image or RGB array with the shape
+        (rows, columns, 3). Resolution and length of the preview get updated accordingly.
+        """
+        if which not in ('highres', 'lowres'):
+            raise ValueError("which must be 'highres' or 'lowres'")
+        if isinstance(image, np.ndarray):
+            imgarr = image
+        else:
+            if not isinstance(image, Image.Image):
+                image = Image.open(image)
+            imgarr = np.asarray(image.convert('RGB'))
+        if imgarr.ndim != 3 or imgarr.shape[2] != 3:
+            raise ValueError('preview images must have the shape (rows, columns, 3)')
+        data = imgarray_to_preview(imgarr)
+        setattr(self, 'preview_{}_resolution_x'.format(which), imgarr.shape[1])
+        setattr(self, 'preview_{}_resolution_y'.format(which), imgarr.shape[0])
+        setattr(self, 'preview_{}_data'.format(which), data)
+        setattr(self, 'preview_{}_data_length'.format(which), len(data))
+
+    def statistics(self, workers=None):
+        """
+        Computes print statistics from the layer data without decoding images. With workers > 1 the layers get split
+        into chunks processed by a pool of processes. Returns a dict with:
+            exposed_pixels: number of exposed pixels per layer and level, shape (n_layers, layer_levels).
+            area_mm2: exposed area per layer, averaged over the levels (anti-aliasing).
+            bbox: row_min, row_max, column_min, column_max of all exposed pixels per layer, -1 for empty layers.
+            volume_ml: total resin volume calculated from the area and layer_thickness of each layer.
+        """
+        shape = (self.resolution_y, self.resolution_x)
+        sublayers = [sublayer for layer in self.layers for sublayer in layer.sublayers]
+        n_layers = len(self.layers)
+        parallel = workers is not None and workers > 1
+        chunksize = 32      # bounds the temporary arrays of the runs and the data copied for the workers
+
+        def tasks():    # generated lazily, only the chunks being processed are copied for the workers
+            for first in range(0, len(sublayers), chunksize):
+                yield [bytes(s._data) if parallel else s._data for s in sublayers[first:first + chunksize]], shape
+
+        results = list(_imap_parallel(_rle_statistics, tasks(), workers))
+        exposed_pixels = np.concatenate([result['exposed_pixels'] for result in results] + [np.zeros(0, dtype=np.int64)])
+        bboxes = np.concatenate([result['bbox'] for result in results] + [np.zeros((0, 4), dtype=np.int64)])
+        exposed_pixels = exposed_pixels.reshape(n_layers, self.layer_levels)
+        bboxes = bboxes.reshape(n_layers, self.layer_levels, 4)
+
+        bbox = np.full((n_layers, 4), -1, dtype=np.int64)
+        empty = bboxes[:, :, 0] < 0
+        bbox[:, 0::2] = np.where(empty[:, :, None], np.iinfo(np.int64).max, bboxes[:, :, 0::2]).min(axis=1)
+        bbox[:, 1::2] = bboxes[:, :, 1::2].max(axis=1)
+        bbox[empty.all(axis=1)] = -1
+
+        pixel_area = (self.bed_x / self.resolution_x) * (self.bed_y / self.resolution_y)
+        area_mm2 = exposed_pixels.mean(axis=1) * pixel_area if n_layers else np.zeros(0)
+        thicknesses = self.get_layer_parameters('layer_thickness')[:, 0]
+        volume_ml = float((area_mm2 * thicknesses).sum() / 1000)
+        return {'exposed_pixels': exposed_pixels, 'area_mm2': area_mm2, 'bbox': bbox, 'volume_ml': volume_ml}
+
+    def update_print_properties(self, density=1.1, cost_per_ml=None, workers=None):
+        """
+        Updates volume_ml, weight_g and (if cost_per_ml is given) cost_dollars from the layer data. density is the
+        resin density in g/ml. The print properties only get written for files with version > 1. Returns the
+        statistics, see statistics.
+        """
+        statistics = self.statistics(workers)
+        self.volume_ml = statistics['volume_ml']
+        self.weight_g = self.volume_ml * density
+        if cost_per_ml is not None:
+            self.cost_dollars = self.volume_ml * cost_per_ml
+        return statistics
+
+    def validate(self):
+        """
+        Checks the layers for problems which would break a print: wrong number of sublayers, RLE data not decoding
+        to resolution_x * resolution_y pixels and invalid layer parameters. Runs on the RLE data without decoding
+        images. Returns a list with a description of each problem, which is empty if everything is fine. See
+        validate_file for the checks of the file structure.
+        """
+        problems = []
+        if self.resolution_x <= 0 or self.resolution_y <= 0:
+            return ['invalid resolution {}x{}'.format(self.resolution_x, self.resolution_y)]
+        levels = np.array([len(layer.sublayers) for layer in self.layers], dtype=np.int64)
+        if (levels != self.layer_levels).any():
+            idx = np.flatnonzero(levels != self.layer_levels)
+            return ['{} layers without {} sublayers, e.g. layer {}'.format(len(idx), self.layer_levels, idx[0])]
+
+        n_pixels = self.resolution_x * self.resolution_y
+        payloads = [sublayer._data for layer in self.layers for sublayer in layer.sublayers]
+        counts = rle_pixel_counts(payloads)
+        wrong = np.flatnonzero(counts != n_pixels)
+        if len(wrong):
+            layer, level = divmod(int(wrong[0]), self.layer_levels)
+            problems.append('{} sublayers do not decode to {} pixels, e.g. layer {} level {} with {} pixels'.format(
+                len(wrong), n_pixels, layer, level, counts[wrong[0]]))
+
+        parameters = self._parameters.values[self._rows()]
+        for column, name in enumerate(LayerParameters.columns):
+            invalid = np.flatnonzero((~np.isfinite(parameters[:, :, column]) | (parameters[:, :, column] < 0)).any(axis=1))
+            if len(invalid):
+                problems.append('{} layers with invalid {}, e.g. layer {}'.format(len(invalid), name, invalid[0]))
+        return problems
+
+    def footprint(self, workers=None, chunksize=64):
+        """
+        Accumulates all layers from the RLE data in a single pass without decoding images. Sublayers are processed
+        in chunks of chunksize, with workers > 1 in a pool of processes, which only return the runs of exposed pixels
+        to a single accumulator. Returns a dict with:
+            footprint: bool image of all pixels exposed in any layer (top-down projection).
+            heatmap: number of exposures of each pixel (uint32), e.g. for tracking the wear of the LCD.
+            row_density, column_density: number of exposures per row and column of the heatmap.
+            exposed_pixels: number of exposed pixels per layer and level, shape (n_layers, layer_levels).
+            area_mm2: exposed area per layer, averaged over the levels.
+        """
+        shape = (self.resolution_y, self.resolution_x)
+        n = shape[0] * shape[1]
+        chunksize = max(1, min(chunksize, (2**31 - 1) // n))   # keeps pixel positions of a chunk within int32
+        parallel = workers is not None and workers > 1
+        sublayers = [sublayer for layer in self.layers for sublayer in layer.sublayers]
+
+        def tasks():
+            for first in range(0, len(sublayers), chunksize):
+                yield [bytes(s._data) if parallel else s._data for s in sublayers[first:first + chunksize]], shape
+
+        # exposures start at the start of a run and end at its stop, their cumulative sum is the heatmap
+        changes = np.zeros(n + 1, dtype=np.int64)
+        exposed_pixels = [np.zeros(0, dtype=np.int64)]
+        for starts, stops, exposed in _imap_parallel(_exposure_boundaries, tasks(), workers):
+            np.add.at(changes, starts, 1)
+            np.add.at(changes, stops, -1)
+            exposed_pixels.append(exposed)
+        heatmap = np.cumsum(changes[:-1]).astype(np.uint32).reshape(shape)
+        exposed_pixels = np.concatenate(exposed_pixels).reshape(len(self.layers), self.layer_levels)
+        pixel_area = (self.bed_x / self.resolution_x) * (self.bed_y / self.resolution_y)
+        return {
+            'footprint': heatmap > 0,
+            'heatmap': heatmap,
+            'row_density': heatmap.sum(axis=1, dtype=np.int64),
+            'column_density': heatmap.sum(axis=0, dtype=np.int64),
+            'exposed_pixels': exposed_pixels,
+            'area_mm2': exposed_pixels.mean(axis=1) * pixel_area if len(self.layers) else np.zeros(0),
+        }
+
+    def find_islands(self, workers=None, connectivity=4, chunksize=32):
+        """
+        Finds islands: connected regions of a layer which don't overlap with the exposed pixels of the layer below and
+        would print into the resin. The first layer is supported by the build plate. Components are found on the runs of
+        the RLE data without decoding images (see rle_components). For multiple levels, pixels exposed in any level
+        count. Layers are processed in chunks of chunksize, with workers > 1 in a pool of processes, keeping only a
+        few chunks in memory. Returns a list with a dict per island with the layer index, area (pixels) and centroid
+        (row, column).
+        """
+        shape = (self.resolution_y, self.resolution_x)
+        parallel = workers is not None and workers > 1
+
+        def tasks():
+            for first in range(0, len(self.layers), chunksize):
+                layers = [[bytes(s._data) if parallel else s._data for s in layer.sublayers]
+                          for layer in self.layers[max(first - 1, 0):first + chunksize]]
+                previous = layers.pop(0) if first > 0 else None
+                yield layers, first, previous, shape, connectivity
+
+        return [island for islands in _imap_parallel(_find_islands, tasks(), workers) for island in islands]
+
+    def fingerprints(self, workers=None):
+        """
+        Returns the fingerprints of all layers as list with a tuple of the sublayer fingerprints per layer. Missing
+        fingerprints are computed with workers threads.
+        """
+        sublayers = [sublayer for layer in self.layers for sublayer in layer.sublayers if sublayer._fingerprint is None]
+        for sublayer, fingerprint in zip(sublayers, _map_threads(payload_hash, [s._data for s in sublayers], workers)):
+            sublayer._fingerprint = fingerprint
+        return [tuple(sublayer._fingerprint for sublayer in layer.sublayers) for layer in self.layers]
+
+    def _layer_parameters(self):
+        """
+        Returns layer_thickness, exposure_time and off_time of all sublayers as array with shape (n_layers, levels, 3),
+        rounded to 4 decimals.
+        """
+        return self._parameters.values[self._rows()].round(4)   # same precision as SubLayer.__eq__
+
+    def _header_values(self):
+        """
+        Returns the global values of the file as dict. Preview data is represented by its fingerprint.
+        """
+        names = ['version', 'layer_levels', 'resolution_x', 'resolution_y']
+        names += [name for name, _, _ in HEADER_FIELDS + HEADER_FIELDS_V2 + PRINT_PROPERTY_FIELDS]
+        names += ['anti_aliasing_level', 'preview_highres_resolution_x', 'preview_highres_resolution_y',
+                  'preview_lowres_resolution_x', 'preview_lowres_resolution_y']
+        values = {name: getattr(self, name, None) for name in names}
+        values['n_layers'] = len(self.layers)
+        values['preview_highres_data'] = payload_hash(self.preview_highres_data).hex()
+        values['preview_lowres_data'] = payload_hash(self.preview_lowres_data).hex()
+        return values
+
+    def diff(self, other, workers=None):
+        """
+        Compares this Photon-file (a) against other (b) using fingerprints of the layer data, without decoding any
+        images. Layers are aligned, so that inserted or removed layers don't show up as changes of all following
+        layers. Returns a dict with:
+            header: {name: (value_a, value_b)} for all differing global values.
+            added: indices of layers in b without counterpart in a.
+            removed: indices of layers in a without counterpart in b.
+            changed: (index_a, index_b) of layers with different layer data.
+            parameters: (index_a, index_b, {name: (values_a, values_b)}) of layers with the same data but different
+                layer_thickness, exposure_time or off_time. values are lists with one value per sublayer.
+        """
+        values_a, values_b = self._header_values(), other._header_values()
+        header = {name: (values_a[name], values_b[name]) for name in values_a
+                  if values_a[name] != values_b[name] and not (isinstance(values_a[name], float) and
+                                                                np.float32(values_a[name]) == np.float32(values_b[name]))}
+        fingerprints_a, fingerprints_b = self.fingerprints(workers), other.fingerprints(workers)
+        parameters_a, parameters_b = self._layer_parameters(), other._layer_parameters()
+
+        result = {'header': header, 'added': [], 'removed': [], 'changed': [], 'parameters': []}
+        names = ['layer_thickness', 'exposure_time', 'off_time']
+        matcher = difflib.SequenceMatcher(None, fingerprints_a, fingerprints_b, autojunk=False)
+        for tag, a0, a1, b0, b1 in matcher.get_opcodes():
+            if tag == 'equal':
+                differs = parameters_a[a0:a1] != parameters_b[b0:b1]
+                for offset in np.flatnonzero(differs.any(axis=(1, 2))):
+                    a, b = a0 + int(offset), b0 + int(offset)
+                    fields = np.flatnonzero(differs[offset].any(axis=0))
+                    result['parameters'].append((a, b, {names[k]: (parameters_a[a, :, k].tolist(), parameters_b[b, :, k].tolist())
+                                                        for k in fields}))
+            else:   # layers replacing each other count as changed, the rest as added or removed
+                n = min(a1 - a0, b1 - b0)
+                result['changed'] += [(a0 + k, b0 + k) for k in range(n)]
+                result['removed'] += list(range(a0 + n, a1))
+                result['added'] += list(range(b0 + n, b1))
+        return result
+
+    def _transform(self, function, args=(), workers=None):
+        """
+        Replaces the data of all sublayers with function(data, *args), see the rle_* transforms. Data shared by
+        several sublayers is only transformed once. With workers > 1 a pool of processes is used.
+        """
+        sublayers = [sublayer for layer in self.layers for sublayer in layer.sublayers]
+        payloads = {}
+        for sublayer in sublayers:
+            payloads.setdefault(id(sublayer._data), sublayer._data)
+        keys = list(payloads)
+        parallel = workers is not None and workers > 1
+        chunksize = 32
+
+        def tasks():    # generated lazily, only the chunks being transformed are copied for the workers
+            for first in range(0, len(keys), chunksize):
+                yield [(function, bytes(payloads[key]) if parallel else payloads[key]) + tuple(args)
+                       for key in keys[first:first + chunksize]]
+
+        results = dict(zip(keys, (data for chunk in _imap_parallel(_rle_transforms, tasks(), workers) for data in chunk)))
+        for sublayer in sublayers:
+            sublayer._data = results[id(sublayer._data)]
+
+    def translate(self, dx, dy, workers=None):
+        """
+        Moves all layers by dx columns and dy rows (in pixels) on the build plate. Exposed pixels moved off the plate
+        get lost. Works on the RLE data without decoding images, with workers > 1 in a pool of processes.
+        """
+        self._transform(rle_translate, (dx, dy, (self.resolution_y, self.resolution_x)), workers)
+
+    def mirror(self, axis='x', workers=None):
+        """
+        Mirrors all layers along axis: 'x' swaps left and right, 'y' top and bottom. See translate.
+        """
+        self._transform(rle_mirror, (axis, (self.resolution_y, self.resolution_x)), workers)
+
+    def invert(self, workers=None):
+        """
+        Swaps exposed and dark pixels of all layers. See translate.
+        """
+        self._transform(rle_invert, (), workers)
+
+    def crop(self, left, top, width, height, workers=None):
+        """
+        Crops all layers to the region with the given offset and size in pixels, which becomes the new resolution.
+        Parts of the region outside of the build plate are padded with dark pixels. bed_x and bed_y are scaled to keep
+        the size of a pixel. See translate.
+        """
+        self._transform(rle_crop, (left, top, width, height, (self.resolution_y, self.resolution_x)), workers)
+        self.bed_x = self.bed_x * width / self.resolution_x
+        self.bed_y = self.bed_y * height / self.resolution_y
+        self.resolution_x, self.resolution_y = width, height
+        self.image_cache.clear()
+        self.image_cache.shape = (height, width)
+
+    def merge(self, other, dx=0, dy=0, workers=None):
+        """
+        Places the layers of the Photon-file other, moved by dx columns and dy rows, on the build plate of this one.
+        Layers are merged by index. If other has more layers, they get appended with their parameters. Both files
+        need the same number of levels. See translate.
+        """
+        if other.layer_levels != self.layer_levels:
+            raise ValueError('both files need the same number of levels')
+        shape = (self.resolution_y, self.resolution_x)
+        other_shape = (other.resolution_y, other.resolution_x)
+        n_common = min(len(self.layers), len(other.layers))
+        sublayers = [sublayer for layer in self.layers[:n_common] for sublayer in layer.sublayers]
+        others = [sublayer for layer in other.layers for sublayer in layer.sublayers]
+        parallel = workers is not None and workers > 1
+        chunksize = 32
+
+        def tasks():    # generated lazily like in _transform
+            for first in range(0, len(others), chunksize):
+                chunk = []
+                for i in range(first, min(first + chunksize, len(others))):
+                    other_data = bytes(others[i]._data) if parallel else others[i]._data
+                    if i < len(sublayers):
+                        data = bytes(sublayers[i]._data) if parallel else sublayers[i]._data
+                        chunk.append((rle_merge, data, other_data, dx, dy, shape, other_shape))
+                    else:
+                        chunk.append((rle_crop, other_data, -dx, -dy, shape[1], shape[0], other_shape))
+                yield chunk
+
+        results = [data for chunk in _imap_parallel(_rle_transforms, tasks(), workers) for data in chunk]
+        for sublayer, data in zip(sublayers, results):
+            sublayer._data = data
+        for i in range(n_common, len(other.layers)):
+            layer = Layer()
+            for level, other_sublayer in enumerate(other.layers[i].sublayers):
+                data = results[i * self.layer_levels + level]
+                layer.append_sublayer(SubLayer(data, other_sublayer.layer_thickness, other_sublayer.exposure_time, other_sublayer.off_time))
+            self._attach(layer)
+            self.layers.append(layer)
+
+    def export_images(self, dirpath, workers=None, mode='RGB', layers=None):
+        """
+        Exports all containing layer images to a supplied directory. With workers > 1 decoding and saving is spread
+        over a pool of processes. mode selects the output format, see export_image. layers selects the exported
+        layers as slice or list of indices, the files keep the index of the layer in their name.
         """
         try:
             os.makedirs(dirpath)
         except OSError:
             pass
-        for i, layer in enumerate(self.layers):
-            for j, sublayer in enumerate(layer.sublayers):
-                self.export_image(sublayer, os.path.join(dirpath, '{:05d}_{:02d}.png'.format(i, j)))
+        extension = '.npy' if mode == 'npy' else '.png'
+        shape = (self.resolution_y, self.resolution_x)
+        if layers is None:
+            layers = slice(None)
+        indices = range(len(self.layers))[layers] if isinstance(layers, slice) else layers
+        parallel = workers is not None and workers > 1
+
+        def tasks():    # generated lazily, only the layers being exported are copied for the workers
+            for i in indices:
+                for j, sublayer in enumerate(self.layers[i].sublayers):
+                    filepath = os.path.join(dirpath, '{:05d}_{:02d}{}'.format(i, j, extension))
+                    data = bytes(sublayer._data) if parallel else sublayer._data  # memoryviews of mapped files can't be pickled
+                    yield data, shape, filepath, mode
+        for _ in _imap_parallel(_export_image, tasks(), workers):
+            pass
 
-    def export_image(self, sublayer, filepath):
+    def export_image(self, sublayer, filepath, mode='RGB'):
         """
-        Exports layer image at idx to the supplied filename.
+        Exports layer image at idx to the supplied filename. mode is one of 'RGB' (24 bit png), 'L' (8 bit grayscale
+        png), '1' (1 bit png) or 'npy' (numpy array of 0 and 1 as written by np.save). Everything except 'RGB' is
+        considerably faster and smaller.
         """
-        img = rle_to_imgarray(sublayer._data).astype('uint8') * 255
-        Image.fromarray(img).convert('RGB').save(filepath)
-
+        _export_image((sublayer._data, (self.resolution_y, self.resolution_x), filepath, mode))
 
-    def create_layer(self, images, layer_thickness=None, exposure_time=None, off_time=None):
+    def create_layer(self, images, layer_thickness=None, exposure_time=None, off_time=None, layer_idx=None, threshold=0):
+        """
+        Creates a new Layer without adding it. layer_idx is the position the layer is meant for and decides whether the
+        bottom exposure applies. Defaults to appending. Pixels of images > threshold are exposed, e.g. threshold=127
+        for grayscale images.
+        """
+        if layer_idx is None:
+            layer_idx = len(self.layers)
         if not isinstance(images, list):
             images = [images]
-        if len(images) != self.layer_levels:
+        if len(images) != self.layer_levels and len(images) != 1:
+            raise ValueError('supplied number of images must equal to number of levels in file')
+        payloads = _encode_layer((images, (self.resolution_y, self.resolution_x), self.layer_levels, threshold))
+        if len(payloads) != self.layer_levels:
             raise ValueError('supplied number of images must equal to number of levels in file')
         layer = Layer()
-        for image in images:
-            if not isinstance(image, bytes):
-                data = imgarr_to_rle(image_to_imgarr(image))
-            else:
-                data = image
+        for data in payloads:
             if layer_thickness is None:
                 layer_thickness = self.layer_height
             if exposure_time is None:
-                if len(self.layers) < self.bottom_layers:
+                if layer_idx < self.bottom_layers:
                     exposure_time = self.exposure_time_bottom
                 else:
                     exposure_time = self.exposure_time
             if off_time is None:
                 off_time = self.off_time
             layer.append_sublayer(SubLayer(data, layer_thickness, exposure_time, off_time))
+        self._attach(layer)
         return layer
 
-    def append_layer(self, images, layer_thickness=None, exposure_time=None, off_time=None):
+    def set_anti_aliasing_level(self, levels):
         """
-        Appends a new layer. In case of multiple levels, the correct number of images must be supplied as a list. images should be a path or already rle encoded bytes object. Argument exposure_time
+        Sets the number of anti-aliasing levels (sublayers per layer) of a Photon-file without layers. Version 1 files
+        get converted to version 2 with default print properties, as anti-aliasing is not supported by version 1.
+        """
+        if self.layers:
+            raise ValueError('the anti-aliasing level can only be changed for files without layers')
+        if levels < 1:
+            raise ValueError('levels must be at least 1')
+        if self.version < 2:
+            if levels == 1:
+                return
+            self.version = 2
+            self.print_time = 0
+            self.print_properties_length = len(PRINT_PROPERTY_FIELDS) * 4
+            self.light_pwm = 255
+            self.light_pwm_bottom = 255
+            self.bottom_lift_distance = 5.0
+            self.bottom_lift_speed = 60.0
+            self.lifting_distance = 5.0
+            self.lifting_speed = 60.0
+            self.retract_speed = 150.0
+            self.volume_ml = 0.0
+            self.weight_g = 0.0
+            self.cost_dollars = 0.0
+            self.bottom_light_off_delay = 0.0
+            self.light_off_delay = 0.0
+            self.bottom_layer_count = self.bottom_layers
+            self.p1 = self.p2 = self.p3 = self.p4 = 0.0
+        self.anti_aliasing_level = levels
+        self.layer_levels = levels
+
+    @classmethod
+    def _from_template(cls, template, levels=None):
+        """
+        Returns a Photon-file without layers with the header values of template (a path, None for the defaults of a
+        new file). levels sets the anti-aliasing level, see set_anti_aliasing_level.
+        """
+        photon = cls() if template is None else cls(template, header_only=True)
+        photon.delete_layers()
+        if levels is not None and levels != photon.layer_levels:
+            photon.set_anti_aliasing_level(levels)
+        # the new file has nothing to do with the template file, save_in_place must not overwrite it
+        photon._filepath = None
+        photon._origin = None
+        photon.layer_table = np.zeros((photon.layer_levels, 0), dtype=LAYER_DEF_DTYPE)
+        return photon
+
+    @classmethod
+    def from_volume(cls, volume, layer_thickness=None, exposure_time=None, off_time=None, template=None, threshold=0):
+        """
+        Creates a new Photon-file from a volume with the shape (layers, rows, columns), or (layers, levels, rows,
+        columns) for multiple levels. The volume can be any array like a np.memmap or a BitStack. Layers are encoded one
+        by one from views of the volume without copying them. Header values are taken from the file template (e.g. for
+        the resolution), for 4 dimensional volumes with the anti-aliasing level of the volume. Keyword args are used as
+        in append_layer.
+        """
+        photon = cls._from_template(template, volume.shape[1] if len(volume.shape) == 4 else None)
+        for layer in volume:
+            images = list(layer) if layer.ndim == 3 else layer
+            photon.append_layer(images, layer_thickness, exposure_time, off_time, threshold)
+        return photon
+
+    def export_stack(self, filepath, workers=None):
+        """
+        Writes all layers bit-packed to the .npy file filepath and returns it as BitStack. It takes 1 bit per pixel, so
+        volumes of thousands of layers can be memory-mapped. With workers > 1 the layers get decoded by a pool of
+        processes writing into the file directly.
+        """
+        shape = (self.resolution_y, self.resolution_x)
+        stack = np.lib.format.open_memmap(filepath, mode='w+', dtype=np.uint8,
+                                          shape=(len(self.layers), self.layer_levels, shape[0], -(-shape[1] // 8)))
+        del stack   # closes the file, the layers get written by _pack_layers
+        parallel = workers is not None and workers > 1
+        chunksize = 32 if parallel else max(len(self.layers), 1)
+
+        def tasks():    # generated lazily, only the chunks being packed are copied for the workers
+            for first in range(0, len(self.layers), chunksize):
+                payloads = [[bytes(s._data) if parallel else s._data for s in layer.sublayers]
+                            for layer in self.layers[first:first + chunksize]]
+                yield filepath, first, payloads, shape
+
+        for _ in _imap_parallel(_pack_layers, tasks(), workers):
+            pass
+        return BitStack(filepath, self.resolution_x)
+
+    @classmethod
+    def from_stack(cls, filepath, layer_thickness=None, exposure_time=None, off_time=None, workers=None, columns=None,
+                   template=None):
+        """
+        Creates a new Photon-file from a bit-packed stack written by export_stack, see BitStack for columns. With
+        workers > 1 the layers get encoded by a pool of processes sharing the memory-mapped stack. The anti-aliasing
+        level is the one of the stack, other header values are taken from the file template. Keyword args are used as
+        in append_layer.
+        """
+        stack = BitStack(filepath, columns)
+        photon = cls._from_template(template, stack.shape[1])
+        if stack.shape[2:] != (photon.resolution_y, photon.resolution_x):
+            raise ValueError('the stack must have the resolution {}'.format((photon.resolution_y, photon.resolution_x)))
+        chunksize = max(1, -(-len(stack) // (workers * 4))) if workers is not None and workers > 1 else max(len(stack), 1)
+        tasks = [(filepath, first, first + chunksize, stack.columns) for first in range(0, len(stack), chunksize)]
+        for layers in _map_parallel(_unpack_layers, tasks, workers, chunksize=1):
+            for levels in layers:
+                photon.append_layer(levels, layer_thickness, exposure_time, off_time)
+        return photon
+
+    def append_layer(self, images, layer_thickness=None, exposure_time=None, off_time=None, threshold=0):
+        """
+        Appends a new layer. In case of multiple levels, the correct number of images must be supplied as a list, or a single grayscale image which gets split into the levels (see grayscale_to_rle). images should be a path, PIL image, 2D numpy array (rows x columns, non-zero pixels are exposed) or already rle encoded bytes object. Pixels > threshold are exposed, e.g. threshold=127 for grayscale images. Argument exposure_time
         seems to be not used by the firmware. If keyword args are ommited, falls back to global values.
         """
-        layer = self.create_layer(images, layer_thickness, exposure_time, off_time)
+        layer = self.create_layer(images, layer_thickness, exposure_time, off_time, threshold=threshold)
         self.layers.append(layer)
 
-    def append_layers(self, dirpath, layer_thickness=None, exposure_time=None, off_time=None):
+    def append_layers(self, dirpath, layer_thickness=None, exposure_time=None, off_time=None, workers=None, threshold=0):
         """
-        Appends multiple new layers. dirpath should be an existing directory. Argument exposure_time
+        Appends multiple new layers. dirpath should be an existing directory or a list with the images of each layer
+        (same as for append_layer, also for threshold). For multiple levels, a directory may also hold a single
+        grayscale image per layer.
+        With workers > 1 images get encoded in a pool of processes. Argument exposure_time
         seems to be not used by the firmware. If keyword args are ommited, falls back to global values.
         """
-        files = glob.glob(os.path.join(dirpath, "[0-9][0-9][0-9][0-9][0-9]_[0-9][0-9].png"))
-        files = sorted(files)
-        layers = []
-        last_file_id = ''
-        for filepath in files:
-            file_id = os.path.basename(filepath)[:5]
-            if file_id == last_file_id:
-                layers[-1].append(filepath)
-            else:
-                layers.append([filepath])
-                last_file_id = file_id
-        for layer in layers:
-            self.append_layer(layer, layer_thickness, exposure_time, off_time)
-
-    def insert_layer(self, images, idx, layer_thickness=None, exposure_time=None, off_time=None):
+        if isinstance(dirpath, list):
+            layers = [images if isinstance(images, list) else [images] for images in dirpath]
+        else:
+            layers = layer_files(dirpath)
+        tasks = [(images, (self.resolution_y, self.resolution_x), self.layer_levels, threshold) for images in layers]
+        for payloads in _map_parallel(_encode_layer, tasks, workers):    # results keep the order of the layers
+            self.append_layer(payloads, layer_thickness, exposure_time, off_time)
+
+    def insert_layer(self, images, idx, layer_thickness=None, exposure_time=None, off_time=None, threshold=0):
         """
         Insert a new layer at idx. Not tested. Argument exposure_time
         seems to be not used by the firmware. If keyword args are ommited, falls back to global values.
         """
-        layer = self.create_layer(images, layer_thickness, exposure_time, off_time)
+        layer = self.create_layer(images, layer_thickness, exposure_time, off_time, layer_idx=idx, threshold=threshold)
         self.layers.insert(idx, layer)
 
-    def replace_layer(self, images, idx, layer_thickness=None, exposure_time=None, off_time=None):
+    def replace_layer(self, images, idx, layer_thickness=None, exposure_time=None, off_time=None, threshold=0):
         """
         Replaces a layer a layer at idx with a nw layer. Not tested. Argument exposure_time
         seems to be not used by the firmware. If keyword args are ommited, falls back to global values.
         """
-        layer = self.create_layer(images, layer_thickness, exposure_time, off_time)
+        layer = self.create_layer(images, layer_thickness, exposure_time, off_time, layer_idx=idx, threshold=threshold)
         self.delete_layer(idx)
-        self.insert_layer(idx, layer)
+        self.layers.insert(idx, layer)
 
     def delete_layer(self, idx):
         """
         Delete layer at idx.
         """
-        self.layers.pop(idx)
+        layer = self.layers.pop(idx)
+        for sublayer in layer.sublayers:
+            self.image_cache.invalidate(sublayer)
 
     def delete_layers(self):
         """
         Delete all layers.
         """
         self.layers = []
+        self.image_cache.clear()
+        self._parameters = LayerParameters()    # removed sublayers keep the old one
 
     def overwrite_layer_parameters(self, layer_thickness=None, exposure_time=None, off_time=None):
         """
@@ -473,12 +2222,193 @@ class Photon:
         note that exposure time seems to be ignored on a per layer basis. If keyword args are ommited, falls
         back to global values.
         """
-        for layer in self.layers:
-            for sublayer in layer.sublayers:
-                if layer_thickness:
-                    sublayer.layer_thickness = layer_thickness
-                if exposure_time:
-                    sublayer.exposure_time = exposure_time
-                if off_time:
-                    sublayer.off_time = off_time
+        rows = self._rows()
+        if layer_thickness:
+            self._parameters.values[rows, 0] = layer_thickness
+        if exposure_time:
+            self._parameters.values[rows, 1] = exposure_time
+        if off_time:
+            self._parameters.values[rows, 2] = off_time
 
+
+class PhotonWriter:
+    """
+    Writes a Photon-file layer by layer without holding all layers in memory. The number of layers has to be declared
+    upfront, so that the layer table can be skipped and layer data gets streamed to disk directly. The table is
+    written in one go when the writer is closed. Header values are taken from photon (defaults to a new Photon).
+    With dedup, layer data identical to previously written data is not written again but points to the existing copy.
+    Use as context manager or call close() after adding all layers. Everything gets written to a temporary file next
+    to filepath, which only replaces filepath once all layers were written, so that an existing file survives errors.
+    """
+    def __init__(self, filepath, n_layers, photon=None, dedup=False):
+        if photon is None:
+            photon = Photon()
+        self.photon = photon
+        self.n_layers = n_layers
+        self.dedup = dedup
+        self._addresses = {}    # hash of the data -> address, used for dedup
+        self.layer_levels = photon.layer_levels
+        self._table = np.zeros((self.layer_levels, n_layers), dtype=LAYER_DEF_DTYPE)
+        self._heights = [None] * self.layer_levels
+        self._count = 0
+        header, self.addresses = photon._header_bytes(n_layers)
+        self._layer_def_address = len(header)
+        self.filepath = filepath
+        self._temp_filepath = '{}.{}-{}.tmp'.format(filepath, os.getpid(), id(self))
+        # created like open(filepath, 'wb') would, an existing file keeps its permissions
+        fd = os.open(self._temp_filepath, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0o666)
+        self._f = os.fdopen(fd, 'wb')
+        try:
+            if os.path.exists(filepath):
+                shutil.copymode(filepath, self._temp_filepath)
+            self._f.write(header)
+            self._f.seek(self._layer_def_address + self._table.nbytes)   # layer data starts after the table
+        except BaseException:
+            self._discard()
+            raise
+
+    def add_layer(self, layer, layer_thickness=None, exposure_time=None, off_time=None, threshold=0):
+        """
+        Writes the next layer. layer can be a Layer or anything Photon.create_layer accepts, in which case the keyword
+        args get passed on.
+        """
+        if self._count >= self.n_layers:
+            raise ValueError('all {} declared layers have already been added'.format(self.n_layers))
+        if not isinstance(layer, Layer):
+            layer = self.photon.create_layer(layer, layer_thickness, exposure_time, off_time, self._count, threshold)
+        if len(layer.sublayers) != self.layer_levels:
+            raise ValueError('number of sublayers must equal to number of levels in file')
+        with _stage('write.layers') as counts:
+            for level, sublayer in enumerate(layer.sublayers):
+                if self._heights[level] is None:
+                    self._heights[level] = 0.0  # heights in the table start at 0, the thickness of the first layer is ignored
+                else:
+                    self._heights[level] += sublayer.layer_thickness
+                entry = self._table[level, self._count]
+                entry['height'] = _table_heights(self._heights[level])
+                entry['exposure_time'] = sublayer.exposure_time
+                entry['off_time'] = sublayer.off_time
+                data = sublayer._data
+                entry['data_length'] = len(data)
+                if self.dedup:
+                    key = sublayer.fingerprint
+                    if key in self._addresses:
+                        entry['data_address'] = self._addresses[key]
+                        continue
+                    self._addresses[key] = self._f.tell()
+                entry['data_address'] = self._f.tell()
+                self._f.write(data)  # layers in data are sorted: L1 S1, L1 S2, ... LX S1, LX S2. Different than in the table!
+                counts[0] += len(data)
+            counts[1] = 1
+        self._count += 1
+
+    def add_layers(self, layers, layer_thickness=None, exposure_time=None, off_time=None, workers=None, threshold=0):
+        """
+        Writes the next layers from an iterable of layers, each a list of images (or a single image) as accepted by
+        add_layer. With workers > 1 images get encoded in a pool of processes, taking only a few layers from the
+        iterable at a time, so that e.g. the layers of a memory-mapped volume don't have to fit into memory.
+        """
+        shape = (self.photon.resolution_y, self.photon.resolution_x)
+
+        def tasks():
+            for images in layers:
+                if isinstance(images, np.ndarray) and images.ndim == 3:   # (levels, rows, columns)
+                    images = list(images)
+                yield images if isinstance(images, list) else [images], shape, self.layer_levels, threshold
+
+        for payloads in _imap_parallel(_encode_layer, tasks(), workers):
+            self.add_layer(payloads, layer_thickness, exposure_time, off_time)
+
+    def close(self):
+        """
+        Writes the layer table and moves the file to filepath. Raises ValueError if less layers than declared were
+        added, filepath is left untouched then.
+        """
+        if self._f.closed:
+            return
+        try:
+            if self._count != self.n_layers:
+                raise ValueError('{} layers were declared but only {} were added'.format(self.n_layers, self._count))
+            with _stage('write.table') as counts:
+                self._f.seek(self._layer_def_address)
+                self._f.write(self._table.tobytes())
+                counts[0] = self._table.nbytes
+            self._f.close()
+            os.replace(self._temp_filepath, self.filepath)
+        except BaseException:
+            self._discard()
+            raise
+
+    def _discard(self):
+        """
+        Closes and removes the temporary file without touching filepath.
+        """
+        self._f.close()
+        with contextlib.suppress(OSError):
+            os.remove(self._temp_filepath)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._discard()
+
+
+def validate_file(filepath):
+    """
+    Checks the Photon-file at filepath without decoding images: header and layer table have to fit into the file,
+    layer data must not overlap with other data (identical entries sharing data are fine), heights must not decrease
+    and the layers are checked by Photon.validate. Returns a list with a description of each problem, which is
+    empty if everything is fine.
+    """
+    try:
+        file_size = os.path.getsize(filepath)
+        photon = Photon(filepath, memory_map=True)
+    except Exception as e:  # anything going wrong while reading the header or layer table
+        return ['file can not be read: {!r}'.format(e)]
+    with photon:
+        return _file_problems(photon, file_size)
+
+
+def _file_problems(photon, file_size):
+    """
+    Returns the problems of the structure and layers of an opened Photon-file, see validate_file.
+    """
+    problems = []
+    for which in ['highres', 'lowres']:
+        address = getattr(photon, 'preview_{}_data_address'.format(which))
+        length = getattr(photon, 'preview_{}_data_length'.format(which))
+        if address < 0 or length < 0 or address + length > file_size:
+            problems.append('{} preview data out of bounds'.format(which))
+    if photon.version > 1 and photon.print_properties_address + photon.print_properties_length > file_size:
+        problems.append('print properties out of bounds')
+
+    table = photon.layer_table
+    table_end = photon.layer_def_address + table.nbytes
+    addresses = table['data_address'].ravel().astype(np.int64)  # sorted by level, then layer
+    lengths = table['data_length'].ravel().astype(np.int64)
+    bounds = np.flatnonzero((addresses < table_end) | (lengths <= 0) | (addresses + lengths > file_size))
+    if len(bounds):
+        level, layer = divmod(int(bounds[0]), photon.n_layers)
+        problems.append('{} sublayers with data out of bounds, e.g. layer {} level {}'.format(len(bounds), layer, level))
+    blocks = np.unique(np.column_stack([addresses, lengths]), axis=0)   # sorted by address
+    overlaps = np.flatnonzero(blocks[1:, 0] < blocks[:-1, 0] + blocks[:-1, 1])
+    if len(overlaps):
+        problems.append('{} overlapping blocks of layer data, e.g. at address {}'.format(len(overlaps), blocks[overlaps[0] + 1, 0]))
+    decreasing = np.flatnonzero((np.diff(table['height'], axis=1) < 0).any(axis=0))
+    if len(decreasing):
+        problems.append('{} layers with decreasing height, e.g. layer {}'.format(len(decreasing), decreasing[0] + 1))
+    if not len(bounds):     # layer data can only be checked if it is in the file
+        problems += photon.validate()
+    return problems
+
+
+def validate_files(filepaths, workers=None):
+    """
+    Validates multiple files with validate_file, with workers > 1 in a pool of processes. Returns a dict of filepath ->
+    list of problems.
+    """
+    return dict(zip(filepaths, _map_parallel(validate_file, filepaths, workers)))
@@ -19,6 +19,9 @@ setup(name='pyphotonfile',
         'pyphotonfile': ['newfile.photon'],
         },
       install_requires=['numpy', 'Pillow'],
+      entry_points={
+        'console_scripts': ['pyphotonfile=pyphotonfile.cli:main'],
+        },
       classifiers=[
         "Programming Language :: Python :: 3",
         "License :: OSI Approved :: GNU General Public License v3 or later (GPLv3+)",
@@ -5,12 +5,13 @@ import shutil
 
 @pytest.fixture()
 def temp_folder():
+    dirpath = os.path.join('tests', 'tempdir', '')
     try:
-        os.makedirs('tests\\tempdir\\')
+        os.makedirs(dirpath)
     except OSError:
         pass
-    yield 'tests\\tempdir\\'
+    yield dirpath
     try:
-        shutil.rmtree('tests\\tempdir\\')
+        shutil.rmtree(dirpath)
     except:
         traceback.print_exc()
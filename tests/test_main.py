@@ -2,27 +2,33 @@ import pytest
 import os
 import glob
 import pyphotonfile
+import numpy as np
+from PIL import Image
 from pyphotonfile import photonfile
+from pyphotonfile import cli
+
+TESTFILES = os.path.join(os.path.dirname(__file__), 'testfiles')
+REFERENCE = os.path.join(TESTFILES, 'pyphotonfile_reference.photon')
 
 
 def test_photonfile_no_modifications(temp_folder):
-    photon = photonfile.Photon('tests\\testfiles\\pyphotonfile_reference.photon')
+    photon = photonfile.Photon(REFERENCE)
     photon.write(os.path.join(temp_folder + 'pyphotonfile_reference.photon'))
 
     with open(os.path.join(temp_folder + 'pyphotonfile_reference.photon'), 'rb') as f:
         new_crc = f.read()
-    with open('tests\\testfiles\\pyphotonfile_reference.photon', 'rb') as f:
+    with open(REFERENCE, 'rb') as f:
         old_crc = f.read()
     assert old_crc == new_crc
 
 def test_photonfile_replace_images(temp_folder):
-    photon_original = photonfile.Photon('tests\\testfiles\\pyphotonfile_reference.photon')
+    photon_original = photonfile.Photon(REFERENCE)
     # photon_original.write(os.path.join(temp_folder + 'pyphotonfile_reference.photon'))
-    photon_new = photonfile.Photon('tests\\testfiles\\pyphotonfile_reference.photon')
+    photon_new = photonfile.Photon(REFERENCE)
     photon_new.export_images(temp_folder)
     photon_new.delete_layers()
     paths = []
-    for filepath in glob.glob(os.path.join(temp_folder, '*.png')):
+    for filepath in sorted(glob.glob(os.path.join(temp_folder, '*.png'))):
         paths.append(filepath)
         photon_new.append_layer(paths[-1])
     photon_new.write(os.path.join(temp_folder + 'pyphotonfile_reference.photon'))
@@ -30,12 +36,12 @@ def test_photonfile_replace_images(temp_folder):
 
     with open(os.path.join(temp_folder + 'pyphotonfile_reference.photon'), 'rb') as f:
         new_crc = f.read()
-    with open('tests\\testfiles\\pyphotonfile_reference.photon', 'rb') as f:
+    with open(REFERENCE, 'rb') as f:
         old_crc = f.read()
     assert old_crc == new_crc
 
 def test_photonfile_new(temp_folder):
-    photon_original = photonfile.Photon('tests\\testfiles\\pyphotonfile_reference.photon')
+    photon_original = photonfile.Photon(REFERENCE)
     photon_new = photonfile.Photon()
     photon_original.export_images(temp_folder)
     photon_new.append_layers(temp_folder)
@@ -43,13 +49,13 @@ def test_photonfile_new(temp_folder):
 
 
 def test_photonfile_properties(temp_folder):
-    photon_original = photonfile.Photon('tests\\testfiles\\pyphotonfile_reference.photon')
+    photon_original = photonfile.Photon(REFERENCE)
     # photon_original.write(os.path.join(temp_folder + 'pyphotonfile_reference.photon'))
-    photon_new = photonfile.Photon('tests\\testfiles\\pyphotonfile_reference.photon')
+    photon_new = photonfile.Photon(REFERENCE)
     photon_new.export_images(temp_folder)
     photon_new.delete_layers()
     paths = []
-    for filepath in glob.glob(os.path.join(temp_folder, '*.png')):
+    for filepath in sorted(glob.glob(os.path.join(temp_folder, '*.png'))):
         paths.append(filepath)
         photon_new.append_layer(paths[-1])
     photon_new.write(os.path.join(temp_folder + 'pyphotonfile_reference.photon'))
@@ -58,33 +64,649 @@ def test_photonfile_properties(temp_folder):
     for layer_new, layer_old in zip(photon_new.layers, photon_original.layers):
         parameters_valid.append(layer_new == layer_old)
 
-    parameters_valid.append(photon_new._header == photon_original._header)
-    parameters_valid.append(photon_new._bed_x == photon_original._bed_x)
-    parameters_valid.append(photon_new._bed_y == photon_original._bed_y)
-    parameters_valid.append(photon_new._bed_z == photon_original._bed_z)
+    parameters_valid.append(photon_new.header == photon_original.header)
+    parameters_valid.append(photon_new.bed_x == photon_original.bed_x)
+    parameters_valid.append(photon_new.bed_y == photon_original.bed_y)
+    parameters_valid.append(photon_new.bed_z == photon_original.bed_z)
     parameters_valid.append(photon_new.layer_height == photon_original.layer_height)
     parameters_valid.append(photon_new.exposure_time == photon_original.exposure_time)
     parameters_valid.append(photon_new.exposure_time_bottom == photon_original.exposure_time_bottom)
     parameters_valid.append(photon_new.off_time == photon_original.off_time)
     parameters_valid.append(photon_new.bottom_layers == photon_original.bottom_layers)
-    parameters_valid.append(photon_new._resolution_x == photon_original._resolution_x)
-    parameters_valid.append(photon_new._resolution_y == photon_original._resolution_y)
-    parameters_valid.append(photon_new._preview_highres_header_address == photon_original._preview_highres_header_address)
-    parameters_valid.append(photon_new._layer_def_address == photon_original._layer_def_address)
+    parameters_valid.append(photon_new.resolution_x == photon_original.resolution_x)
+    parameters_valid.append(photon_new.resolution_y == photon_original.resolution_y)
+    parameters_valid.append(photon_new.preview_highres_header_address == photon_original.preview_highres_header_address)
+    parameters_valid.append(photon_new.layer_def_address == photon_original.layer_def_address)
     parameters_valid.append(len(photon_new.layers) == len(photon_original.layers))
-    parameters_valid.append(photon_new._preview_lowres_header_address == photon_original._preview_lowres_header_address)
-    parameters_valid.append(photon_new._projection_type == photon_original._projection_type)
-    parameters_valid.append(photon_new._preview_highres_resolution_x == photon_original._preview_highres_resolution_x)
-    parameters_valid.append(photon_new._preview_highres_resolution_y == photon_original._preview_highres_resolution_y)
-    parameters_valid.append(photon_new._preview_highres_data_address == photon_original._preview_highres_data_address)
-    parameters_valid.append(photon_new._preview_highres_data_length == photon_original._preview_highres_data_length)
+    parameters_valid.append(photon_new.preview_lowres_header_address == photon_original.preview_lowres_header_address)
+    parameters_valid.append(photon_new.projection_type == photon_original.projection_type)
+    parameters_valid.append(photon_new.preview_highres_resolution_x == photon_original.preview_highres_resolution_x)
+    parameters_valid.append(photon_new.preview_highres_resolution_y == photon_original.preview_highres_resolution_y)
+    parameters_valid.append(photon_new.preview_highres_data_address == photon_original.preview_highres_data_address)
+    parameters_valid.append(photon_new.preview_highres_data_length == photon_original.preview_highres_data_length)
     assert True == all(parameters_valid)  # yes, im a bad boy.
 
+def test_rle_to_imgarray():
+    photon = photonfile.Photon(REFERENCE)
+    for layer in photon.layers:
+        data = layer.sublayers[0]._data
+        imgarr = photonfile.rle_to_imgarray(data)
+        assert imgarr.shape == (2560, 1440)
+        assert imgarr.dtype == np.uint8
+        assert photonfile.imgarr_to_rle(imgarr) == data
+        out = np.ones((2560, 1440), dtype=bool)
+        assert photonfile.rle_to_imgarray(data, out=out) is out
+        assert (out == imgarr.astype(bool)).all()
+    with pytest.raises(ValueError):
+        photonfile.rle_to_imgarray(data[:-1])
+
+def test_rle_to_imgstack():
+    photon = photonfile.Photon(REFERENCE)
+    sublayers = [layer.sublayers[0] for layer in photon.layers]
+    stack = photonfile.rle_to_imgstack(sublayers, dtype=bool)
+    assert stack.shape == (len(sublayers), 2560, 1440)
+    for imgarr, sublayer in zip(stack, sublayers):
+        assert (imgarr == photonfile.rle_to_imgarray(sublayer._data)).all()
+
+def test_photonfile_memory_map(tmp_path):
+    photon = photonfile.Photon(REFERENCE, memory_map=True)
+    assert isinstance(photon.layers[0].sublayers[0]._data, memoryview)
+    assert photon.layers == photonfile.Photon(REFERENCE).layers
+    photon.write(str(tmp_path / 'out.photon'))
+    with open(REFERENCE, 'rb') as f:
+        assert (tmp_path / 'out.photon').read_bytes() == f.read()
+
+def test_photonfile_header_only(tmp_path):
+    photon = photonfile.Photon(REFERENCE, header_only=True)
+    reference = photonfile.Photon(REFERENCE)
+    assert photon.n_layers == reference.n_layers
+    assert photon.exposure_time == reference.exposure_time
+    assert photon.layers[3].sublayers[0]._data_length == len(reference.layers[3].sublayers[0]._data)
+    with pytest.raises(ValueError):
+        photon.layers[0].sublayers[0]._data
+    with pytest.raises(ValueError):
+        photon.write(str(tmp_path / 'out.photon'))
+    assert not (tmp_path / 'out.photon').exists()
+
+def test_photonfile_layer_table():
+    photon = photonfile.Photon(REFERENCE)
+    assert photon.layer_table.shape == (photon.layer_levels, photon.n_layers)
+    for i, layer in enumerate(photon.layers):
+        sublayer = layer.sublayers[0]
+        assert photon.layer_table['exposure_time'][0, i] == sublayer.exposure_time
+        assert photon.layer_table['off_time'][0, i] == sublayer.off_time
+        assert photon.layer_table['data_length'][0, i] == len(sublayer._data)
+    assert photon.layer_table['height'][0, 0] == 0
+    assert (photonfile.Photon(REFERENCE, header_only=True).layer_table == photon.layer_table).all()
+
+def test_photonwriter(tmp_path):
+    photon = photonfile.Photon(REFERENCE)
+    photon.write(str(tmp_path / 'write.photon'))
+    with photonfile.PhotonWriter(str(tmp_path / 'writer.photon'), len(photon.layers), photon) as writer:
+        for layer in photon.layers:
+            writer.add_layer(layer)
+    assert (tmp_path / 'writer.photon').read_bytes() == (tmp_path / 'write.photon').read_bytes()
+    with pytest.raises(ValueError):
+        writer.add_layer(photon.layers[0])
+
+    writer = photonfile.PhotonWriter(str(tmp_path / 'short.photon'), 3, photon)
+    writer.add_layer(photon.layers[0].sublayers[0]._data)
+    with pytest.raises(ValueError):
+        writer.close()
+    assert not (tmp_path / 'short.photon').exists()
+
+def test_export_images_parallel(tmp_path):
+    photon = photonfile.Photon(REFERENCE)
+    photon.export_images(str(tmp_path / 'png'), workers=2, mode='1')
+    photon.export_images(str(tmp_path / 'npy'), mode='npy')
+    photon_new = photonfile.Photon(REFERENCE)
+    photon_new.delete_layers()
+    photon_new.append_layers(str(tmp_path / 'png'))
+    assert photon_new.layers == photon.layers
+    imgarr = np.load(str(tmp_path / 'npy' / '00003_00.npy'))
+    assert (imgarr == photonfile.rle_to_imgarray(photon.layers[3].sublayers[0]._data)).all()
+    with photonfile.Photon(REFERENCE, memory_map=True) as mapped:   # layers get copied for the workers one at a time
+        mapped.export_images(str(tmp_path / 'mapped'), workers=2, mode='npy', layers=slice(3, 4))
+    assert (np.load(str(tmp_path / 'mapped' / '00003_00.npy')) == imgarr).all()
+
+def test_append_layers_parallel(tmp_path):
+    photon = photonfile.Photon(REFERENCE)
+    photon.export_images(str(tmp_path), mode='1')
+    photon_new = photonfile.Photon(REFERENCE)
+    photon_new.delete_layers()
+    photon_new.bottom_layers = 3
+    photon_new.append_layers(str(tmp_path), workers=2)
+    assert [layer.sublayers[0]._data for layer in photon_new.layers] == [layer.sublayers[0]._data for layer in photon.layers]
+    exposure_times = [layer.sublayers[0].exposure_time for layer in photon_new.layers]
+    assert exposure_times == [photon_new.exposure_time_bottom] * 3 + [photon_new.exposure_time] * (len(photon.layers) - 3)
+
+    paths = sorted(glob.glob(os.path.join(str(tmp_path), '*.png')))
+    photon_new.append_layers(paths[:2], workers=2)
+    assert len(photon_new.layers) == len(photon.layers) + 2
+    assert photon_new.layers[-1].sublayers[0]._data == photon.layers[1].sublayers[0]._data
+
+def test_photonfile_from_volume(tmp_path):
+    photon = photonfile.Photon(REFERENCE)
+    volume = np.lib.format.open_memmap(str(tmp_path / 'volume.npy'), mode='w+', dtype=np.uint8, shape=(len(photon.layers), 2560, 1440))
+    photonfile.rle_to_imgstack([layer.sublayers[0] for layer in photon.layers], out=volume)
+    photon_new = photonfile.Photon.from_volume(volume)
+    assert [layer.sublayers[0]._data for layer in photon_new.layers] == [layer.sublayers[0]._data for layer in photon.layers]
+
+    photon_new.append_layer(volume[2].astype(bool))
+    photon_new.append_layer(Image.fromarray(volume[3] * 255))
+    assert photon_new.layers[-2].sublayers[0]._data == photon.layers[2].sublayers[0]._data
+    assert photon_new.layers[-1].sublayers[0]._data == photon.layers[3].sublayers[0]._data
+    with pytest.raises(ValueError):
+        photon_new.append_layer(np.zeros((1440, 2560)))
+
+    levels = np.zeros((2, 3, 2560, 1440), dtype=bool)   # (layers, levels, rows, columns)
+    levels[1, :, 100:200, 100:200] = True
+    levels[1, 2, 100:110] = False
+    photon_aa = photonfile.Photon.from_volume(levels)
+    assert photon_aa.version == 2 and photon_aa.layer_levels == 3
+    photon_aa.write(str(tmp_path / 'aa.cbddlp'))
+    photon_aa = photonfile.Photon(str(tmp_path / 'aa.cbddlp'))
+    assert [sublayer.image.sum() for sublayer in photon_aa.layers[1].sublayers] == [10000, 10000, 9000]
+    photon_template = photonfile.Photon.from_volume(levels, template=str(tmp_path / 'aa.cbddlp'), exposure_time=3)
+    assert photon_template.layer_levels == 3 and photon_template.layers[0].sublayers[2].exposure_time == 3
+    with pytest.raises(ValueError):     # the new file is not the template file
+        photon_template.save_in_place()
+    assert len(photonfile.Photon(str(tmp_path / 'aa.cbddlp')).layers) == 2
+
+def test_image_cache():
+    photon = photonfile.Photon(REFERENCE, image_cache_size=3 * 2560 * 1440)
+    images = [layer.sublayers[0].image for layer in photon.layers[:3]]
+    assert photon.layers[0].sublayers[0].image is images[0]
+    assert (photon.image_cache.hits, photon.image_cache.misses) == (1, 3)
+    photon.layers[3].sublayers[0].image    # evicts layer 1, the least recently used one
+    assert len(photon.image_cache) == 3
+    assert photon.layers[1].sublayers[0].image is not images[1]
+    with pytest.raises(ValueError):
+        images[0][0, 0] = 1
+
+    photon.replace_layer(photon.layers[5].sublayers[0]._data, 0)
+    assert (photon.layers[0].sublayers[0].image == photon.layers[5].sublayers[0].image).all()
+    sublayer = photon.layers[2].sublayers[0]
+    photon.delete_layer(2)
+    assert sublayer.image is not photon.layers[2].sublayers[0].image
+    photon.delete_layers()
+    assert len(photon.image_cache) == 0
+
+def test_statistics():
+    photon = photonfile.Photon(REFERENCE)
+    statistics = photon.statistics()
+    for i, layer in enumerate(photon.layers):
+        imgarr = layer.sublayers[0].image
+        rows = np.flatnonzero(imgarr.any(axis=1))
+        columns = np.flatnonzero(imgarr.any(axis=0))
+        assert statistics['exposed_pixels'][i, 0] == imgarr.sum()
+        assert list(statistics['bbox'][i]) == [rows[0], rows[-1], columns[0], columns[-1]]
+    parallel = photon.statistics(workers=2)
+    assert (parallel['bbox'] == statistics['bbox']).all()
+    assert parallel['volume_ml'] == statistics['volume_ml'] > 0
+
+    photon.update_print_properties(density=2, cost_per_ml=0.5)
+    assert photon.volume_ml == statistics['volume_ml']
+    assert photon.weight_g == 2 * photon.volume_ml
+    assert photon.cost_dollars == 0.5 * photon.volume_ml
+    empty = photonfile.rle_statistics([bytes([0x7d] * 29491 + [25])])
+    assert empty['exposed_pixels'][0] == 0 and list(empty['bbox'][0]) == [-1] * 4
+
+def test_preview(tmp_path):
+    photon = photonfile.Photon(REFERENCE)
+    for which in ['highres', 'lowres']:
+        data = getattr(photon, 'preview_{}_data'.format(which))
+        imgarr = photon.get_preview(which)
+        assert imgarr.shape == (getattr(photon, 'preview_{}_resolution_y'.format(which)), getattr(photon, 'preview_{}_resolution_x'.format(which)), 3)
+        assert photonfile.imgarray_to_preview(imgarr) == data
+
+    imgarr = np.zeros((100, 150, 3), dtype=np.uint8)
+    imgarr[20:50, 30:90] = [255, 128, 0]
+    photon.set_preview(imgarr)
+    photon.set_preview(Image.fromarray(imgarr).resize((50, 30)), 'lowres')
+    photon.write(str(tmp_path / 'preview.photon'))
+    photon_new = photonfile.Photon(str(tmp_path / 'preview.photon'), header_only=True)
+    assert (photon_new.get_preview() == imgarr & 0xf8).all()    # 5 bits per color
+    assert photon_new.get_preview('lowres', as_image=True).size == (50, 30)
+    assert photonfile.Photon(str(tmp_path / 'preview.photon')).layers == photon.layers
+
+def test_write_dedup(tmp_path):
+    photon = photonfile.Photon(REFERENCE)
+    layer = photon.layers[-1]
+    for _ in range(10):
+        photon.append_layer(layer.sublayers[0]._data, layer.sublayers[0].layer_thickness, layer.sublayers[0].exposure_time, layer.sublayers[0].off_time)
+    photon.write(str(tmp_path / 'full.photon'))
+    photon.write(str(tmp_path / 'dedup.photon'), dedup=True)
+    assert os.path.getsize(str(tmp_path / 'dedup.photon')) < os.path.getsize(str(tmp_path / 'full.photon'))
+    photon_new = photonfile.Photon(str(tmp_path / 'dedup.photon'))
+    assert photon_new.layers == photon.layers
+    assert len(set(photon_new.layer_table['data_address'][0, -11:])) == 1
+    assert photon_new.layers[-1].sublayers[0]._data is photon_new.layers[-2].sublayers[0]._data
+
+def test_save_in_place(tmp_path):
+    filepath = str(tmp_path / 'patched.photon')
+    photonfile.Photon(REFERENCE).write(filepath)
+    photon = photonfile.Photon(filepath, header_only=True)
+    photon.exposure_time = 12.5
+    photon.bottom_layers = 4
+    photon.overwrite_layer_parameters(layer_thickness=0.03, exposure_time=9, off_time=2)
+    assert photon.save_in_place()
+    photon_full = photonfile.Photon(REFERENCE)
+    photon_full.exposure_time = 12.5
+    photon_full.bottom_layers = 4
+    photon_full.overwrite_layer_parameters(layer_thickness=0.03, exposure_time=9, off_time=2)
+    photon_full.write(str(tmp_path / 'full.photon'))
+    with open(filepath, 'rb') as f1, open(str(tmp_path / 'full.photon'), 'rb') as f2:
+        assert f1.read() == f2.read()
+
+    # repeated patches of the thicknesses give the same heights as a full write
+    photon = photonfile.Photon(filepath, header_only=True)
+    photon_full = photonfile.Photon(filepath)
+    for thickness, first in [(0.03, 3), (0.07, 4)]:
+        for p in [photon, photon_full]:
+            p.set_layer_parameters('layer_thickness', thickness, slice(first, None))
+        assert photon.save_in_place()
+    photon_full.write(str(tmp_path / 'full.photon'))
+    with open(filepath, 'rb') as f1, open(str(tmp_path / 'full.photon'), 'rb') as f2:
+        assert f1.read() == f2.read()
+
+    photon = photonfile.Photon(filepath, header_only=True)
+    photon.resolution_x = 720
+    with pytest.raises(ValueError):     # the layer data would have to be rewritten
+        photon.save_in_place()
+
+    photon = photonfile.Photon(filepath)
+    photon.delete_layer(len(photon.layers) - 1)  # changes the layer count, file has to be rewritten
+    assert not photon.save_in_place()
+    assert photonfile.Photon(filepath).layers == photon.layers
+
+    # a failing rewrite leaves the file untouched
+    data = open(filepath, 'rb').read()
+    photon = photonfile.Photon(filepath, memory_map=True)
+    photon.layer_levels = 2
+    with pytest.raises(ValueError):
+        photon.save_in_place()
+    photon.layer_levels = 1
+    photon.close()
+    with pytest.raises(ZeroDivisionError):
+        with photonfile.PhotonWriter(filepath, 2) as writer:
+            writer.add_layer(photonfile.Photon(filepath).layers[0])
+            1 / 0
+    assert open(filepath, 'rb').read() == data
+    assert sorted(os.listdir(str(tmp_path))) == ['full.photon', 'patched.photon']    # no temporary files are left
+
+def test_diff(capsys):
+    photon_a = photonfile.Photon(REFERENCE)
+    photon_b = photonfile.Photon(REFERENCE, memory_map=True)
+    assert photon_a.diff(photon_b) == {'header': {}, 'added': [], 'removed': [], 'changed': [], 'parameters': []}
+    photon_b.exposure_time = 5
+    photon_b.layers[0].sublayers[0].off_time = 9
+    imgarr = np.zeros((2560, 1440), dtype=bool)
+    imgarr[100:200, 100:300] = True
+    photon_b.append_layer(imgarr)
+    photon_b.replace_layer(imgarr[::-1].copy(), 3)
+    result = photon_a.diff(photon_b, workers=2)
+    assert result['header'] == {'exposure_time': (1.0, 5), 'n_layers': (10, 11)}
+    assert result['added'] == [10]
+    assert result['removed'] == []
+    assert result['changed'] == [(3, 3)]
+    assert result['parameters'] == [(0, 0, {'off_time': ([1.0], [9.0])})]
+
+    assert cli.main(['diff', REFERENCE, REFERENCE]) == 0
+    assert cli.main(['diff', REFERENCE, os.path.join(TESTFILES, 'Smilie.photon')]) == 1
+    assert 'header n_layers: 10 -> 13' in capsys.readouterr().out
+
+def test_layer_parameters(tmp_path):
+    photon = photonfile.Photon(REFERENCE)
+    sublayer = photon.layers[1].sublayers[0]
+    assert not hasattr(sublayer, '__dict__')
+    assert photon.get_layer_parameters('exposure_time').shape == (10, 1)
+    photon.overwrite_layer_parameters(exposure_time=9, off_time=2)
+    assert sublayer.exposure_time == 9 and sublayer.off_time == 2
+    photon.set_layer_parameters('exposure_time', [60, 50, 40], slice(0, 3))
+    assert photon.get_layer_parameters('exposure_time')[:4, 0].tolist() == [60, 50, 40, 9]
+    sublayer.layer_thickness = 0.1
+    assert photon.get_layer_parameters('layer_thickness')[1, 0] == 0.1
+
+    layer = photonfile.Layer()  # layers added directly to the list work as well
+    layer.append_sublayer(photonfile.SubLayer(photon.layers[0].sublayers[0]._data, 0.05, 3, 4))
+    photon.layers.append(layer)
+    assert photon.get_layer_parameters('off_time')[-1, 0] == 4
+    photon.write(str(tmp_path / 'parameters.photon'))
+    assert photonfile.Photon(str(tmp_path / 'parameters.photon')).layers == photon.layers
+
+def test_transforms():
+    shape = (60, 70)
+    rng = np.random.default_rng(0)
+    imgarr = (rng.random(shape) < 0.2).astype(np.uint8)
+    imgarr[10:30, 5:60] = 1
+    other = np.zeros(shape, dtype=np.uint8)
+    other[40:, 50:] = 1
+    data = photonfile.imgarr_to_rle(imgarr)
+    assert photonfile.intervals_to_rle(*photonfile.rle_to_intervals(data, shape), shape) == data
+    assert photonfile.rle_mirror(data, 'x', shape) == photonfile.imgarr_to_rle(imgarr[:, ::-1].copy())
+    assert photonfile.rle_mirror(data, 'y', shape) == photonfile.imgarr_to_rle(imgarr[::-1].copy())
+    assert photonfile.rle_invert(data) == photonfile.imgarr_to_rle(1 - imgarr)
+    translated = np.zeros(shape, dtype=np.uint8)
+    translated[:-7, 3:] = imgarr[7:, :-3]
+    assert photonfile.rle_translate(data, 3, -7, shape) == photonfile.imgarr_to_rle(translated)
+    padded = np.zeros((80, 40), dtype=np.uint8)
+    padded[5:65, :] = imgarr[:, 20:60]
+    assert photonfile.rle_crop(data, 20, -5, 40, 80, shape) == photonfile.imgarr_to_rle(padded)
+    assert photonfile.rle_merge(data, photonfile.imgarr_to_rle(other), shape=shape) == photonfile.imgarr_to_rle(imgarr | other)
+
+    photon = photonfile.Photon(REFERENCE)
+    images = [sublayer.image.copy() for layer in photon.layers for sublayer in layer.sublayers]
+    photon.mirror('x')
+    photon.translate(100, -50, workers=2)
+    photon.crop(0, 0, 1000, 2000)
+    for image, layer in zip(images, photon.layers):
+        assert (layer.sublayers[0].image == np.roll(image[:, ::-1], (-50, 100), axis=(0, 1))[:2000, :1000]).all()
+    assert photon.resolution_x == 1000
+    photon_other = photonfile.Photon(REFERENCE)
+    photon_other.crop(0, 0, 1000, 2000)
+    photon_other.append_layer(np.ones((2000, 1000), dtype=np.uint8))
+    photon.merge(photon_other, dx=10)
+    assert len(photon.layers) == 11
+    assert photon.layers[-1].sublayers[0].image[:, 10:].all() and not photon.layers[-1].sublayers[0].image[:, :10].any()
+
+def test_bitstack(tmp_path):
+    photon = photonfile.Photon(REFERENCE)
+    filepath = str(tmp_path / 'stack.npy')
+    stack = photon.export_stack(filepath, workers=2)
+    assert stack.shape == (10, 1, 2560, 1440)
+    assert stack.packed.nbytes == 10 * 2560 * 1440 // 8
+    for i, layer in enumerate(photon.layers):
+        assert (stack[i][0] == layer.sublayers[0].image).all()
+    assert stack[2:5, 0].shape == (3, 2560, 1440)
+    assert (pyphotonfile.BitStack(filepath)[2:5, 0] == stack[2:5, 0]).all()
+    for photon_new in [photonfile.Photon.from_stack(filepath), photonfile.Photon.from_stack(filepath, workers=2)]:
+        assert photon_new.fingerprints() == photon.fingerprints()
+
+    volume = np.zeros((3, 4, 2560, 1440), dtype=bool)  # anti-aliasing with 4 levels
+    for level in range(4):
+        volume[1:, level, 100 + level:200 - level, 100:300] = True
+    photon_aa = photonfile.Photon.from_volume(volume)
+    stack = photon_aa.export_stack(filepath, workers=2)
+    assert stack.shape == (3, 4, 2560, 1440)
+    for photon_new in [photonfile.Photon.from_stack(filepath, workers=2), photonfile.Photon.from_volume(stack)]:
+        assert photon_new.layer_levels == 4
+        assert photon_new.fingerprints() == photon_aa.fingerprints()
+
+def test_validate(tmp_path):
+    assert photonfile.validate_files([REFERENCE, os.path.join(TESTFILES, 'Smilie.photon')], workers=2) == {
+        REFERENCE: [], os.path.join(TESTFILES, 'Smilie.photon'): []}
+    with open(REFERENCE, 'rb') as f:
+        data = f.read()
+    table = photonfile.Photon(REFERENCE, header_only=True).layer_table
+    with open(str(tmp_path / 'truncated.photon'), 'wb') as f:
+        f.write(data[:-1000])
+    assert photonfile.validate_file(str(tmp_path / 'truncated.photon')) == ['1 sublayers with data out of bounds, e.g. layer 9 level 0']
+    corrupt = bytearray(data)
+    corrupt[table['data_address'][0, 3]] ^= 0x05    # changes the length of the first run
+    with open(str(tmp_path / 'corrupt.photon'), 'wb') as f:
+        f.write(corrupt)
+    assert photonfile.validate_file(str(tmp_path / 'corrupt.photon')) == ['1 sublayers do not decode to 3686400 pixels, e.g. layer 3 level 0 with 3686395 pixels']
+    photon = photonfile.Photon(str(tmp_path / 'corrupt.photon'))
+    photon.layers[2].sublayers[0].off_time = -1
+    assert len(photon.validate()) == 2
+    assert cli.main(['validate', REFERENCE, str(tmp_path / 'corrupt.photon')]) == 1
+
+def test_encoder():
+    rng = np.random.default_rng(0)
+    gray = (rng.random((300, 200)) * 255).astype(np.uint8)
+    gray[100:200] = 0
+    data = photonfile.imgarr_to_rle(gray, threshold=127)
+    assert (photonfile.rle_to_imgarray(data, shape=(300, 200)) == (gray > 127)).all()
+    assert photonfile.imgarr_to_rle(gray > 127) == data
+    assert photonfile.imgarr_to_rle(np.packbits(gray > 127, axis=-1), packed=True) == data
+    assert photonfile.imgarr_to_rle(np.zeros((0, 0))) == b''
+
+    photon = photonfile.Photon()
+    imgarr = np.zeros((2560, 1440), dtype=bool)
+    imgarr[1000:1500, 200:900] = True
+    photon.append_layer(np.packbits(imgarr, axis=-1))
+    photon.append_layer(Image.fromarray(imgarr).convert('1'))
+    assert (photon.layers[0].sublayers[0].image == imgarr).all()
+    assert photon.layers[0] == photon.layers[1]
+    with pytest.raises(ValueError):
+        photon.append_layer(Image.fromarray(imgarr[:100]))
+    photon.crop(0, 0, 1000, 2000)
+    photon.append_layer(imgarr[:2000, :1000])
+    assert photon.layers[2] == photon.layers[0]
+
+def test_encoder_threshold(tmp_path):
+    gray = np.zeros((2560, 1440), dtype=np.uint8)
+    gray[100:200, 100:200] = 100
+    gray[150:200, 100:200] = 200
+    expected = photonfile.imgarr_to_rle(gray > 127)
+    Image.fromarray(gray).save(str(tmp_path / '00000_00.png'))
+    photon = photonfile.Photon()
+    photon.append_layer(gray, threshold=127)
+    photon.append_layer(str(tmp_path / '00000_00.png'), threshold=127)
+    photon.append_layers(str(tmp_path), workers=2, threshold=127)
+    photon.append_layer(gray)   # everything > 0 by default
+    assert [layer.sublayers[0]._data for layer in photon.layers[:3]] == [expected] * 3
+    assert photon.layers[3].sublayers[0].image.sum() == 100 * 100
+    assert photonfile.Photon.from_volume(gray[None], threshold=127).layers[0].sublayers[0]._data == expected
+    with photonfile.PhotonWriter(str(tmp_path / 'out.photon'), 2) as writer:
+        writer.add_layer(gray, threshold=127)
+        writer.add_layers([gray], workers=2, threshold=127)
+    assert [layer.sublayers[0]._data for layer in photonfile.Photon(str(tmp_path / 'out.photon')).layers] == [expected] * 2
+
+def test_grayscale():
+    rng = np.random.default_rng(0)
+    gray = np.zeros((2560, 1440), dtype=np.uint8)
+    gray[500:700, 300:600] = (rng.random((200, 300)) * 255).astype(np.uint8)
+    gray[1000:1200, 100:200] = 255
+    payloads = photonfile.grayscale_to_rle(gray, 4)
+    for k, data in enumerate(payloads):
+        assert (photonfile.rle_to_imgarray(data) == (gray.astype(int) * 4 > k * 255)).all()
+    counts = sum(photonfile.rle_to_imgarray(data).astype(int) for data in payloads)
+    assert (photonfile.rle_to_grayscale(payloads) == counts * 255 // 4).all()
+
+    photon = photonfile.Photon()
+    photon.layer_levels = 4
+    photon.append_layer(gray)
+    photon.append_layer(photon.layers[0].to_grayscale())
+    assert photon.layers[0].sublayers[0]._data == payloads[0]
+    assert photon.layers[0] == photon.layers[1]
+
+def test_find_islands():
+    photon = photonfile.Photon()
+    imgarr = np.zeros((2560, 1440), dtype=bool)
+    imgarr[100:200, 100:200] = True
+    photon.append_layer(imgarr)
+    imgarr = imgarr.copy()
+    imgarr[150:160, 150:400] = True  # overhang, connected to the supported part
+    imgarr[1000:1010, 1000:1020] = True  # island
+    photon.append_layer(imgarr)
+    imgarr = np.zeros((2560, 1440), dtype=bool)
+    imgarr[1000:1010, 1000:1020] = True
+    imgarr[2000, 5:7] = True
+    imgarr[2001, 7] = True  # only touches diagonally
+    photon.append_layer(imgarr)
+    islands = [{'layer': 1, 'area': 200, 'centroid': (1004.5, 1009.5)},
+               {'layer': 2, 'area': 2, 'centroid': (2000.0, 5.5)},
+               {'layer': 2, 'area': 1, 'centroid': (2001.0, 7.0)}]
+    assert photon.find_islands() == islands
+    assert photon.find_islands(workers=2, chunksize=1) == islands
+    assert len(photon.find_islands(connectivity=8)) == 2
+    assert photonfile.Photon(REFERENCE).find_islands() == []
+
+def test_footprint():
+    photon = photonfile.Photon()
+    imgarr = np.zeros((2560, 1440), dtype=bool)
+    imgarr[100:200, 100:200] = True
+    photon.append_layer(imgarr)
+    imgarr = np.zeros((2560, 1440), dtype=bool)
+    imgarr[150:250, 150:160] = True
+    photon.append_layer(imgarr)
+    result = photon.footprint()
+    assert result['heatmap'].max() == 2
+    assert result['heatmap'][150:200, 150:160].min() == 2
+    assert result['footprint'].sum() == 100 * 100 + 50 * 10
+    assert result['exposed_pixels'].tolist() == [[10000], [1000]]
+    assert result['row_density'].sum() == result['column_density'].sum() == 11000
+    parallel = photon.footprint(workers=2, chunksize=1)
+    assert (parallel['heatmap'] == result['heatmap']).all()
+    photon = photonfile.Photon(REFERENCE)
+    expected = sum(layer.sublayers[0].image.astype(np.uint32) for layer in photon.layers)
+    assert (photon.footprint()['heatmap'] == expected).all()
+
+def test_batch(tmp_path):
+    import shutil
+    from pyphotonfile import batch
+    filepaths = [str(tmp_path / 'a.photon'), str(tmp_path / 'b.photon'), str(tmp_path / 'broken.photon')]
+    shutil.copy(REFERENCE, filepaths[0])
+    shutil.copy(REFERENCE, filepaths[1])
+    with open(filepaths[2], 'wb') as f:
+        f.write(b'not a photon file')
+    pipeline = ['validate', ('set', {'exposure_time': 7.5}), ('layer_parameters', {'exposure_time': 7.5}), 'preview',
+                ('write', {'suffix': '_out'})]
+    progress = []
+    results = list(batch.run(filepaths, pipeline, workers=2, memory_limit=1, progress=lambda *args: progress.append(args[:2])))
+    assert progress == [(1, 3), (2, 3), (3, 3)]
+    results = {result['filepath']: result for result in results}
+    assert results[filepaths[2]]['error'] is not None
+    for filepath in filepaths[:2]:
+        assert results[filepath]['error'] is None
+        photon = photonfile.Photon(results[filepath]['results']['write'])
+        assert photon.exposure_time == 7.5
+        assert photon.layers[0].sublayers[0].exposure_time == 7.5
+        assert photon.get_preview().max() > 200   # rendered from the layers, previews are stored with 5 bits per color
+    # the copies of the reference count as large files, they run one at a time next to the pool for small files
+    shutil.copy(os.path.join(TESTFILES, 'Smilie.photon'), str(tmp_path / 'small.photon'))
+    mixed = filepaths[:2] + [str(tmp_path / 'small.photon')]
+    large_file = os.path.getsize(REFERENCE)
+    results = list(batch.run(mixed, ['statistics'], workers=4, memory_limit=1, large_file=large_file))
+    assert sorted(result['filepath'] for result in results) == sorted(mixed)
+    assert all(result['error'] is None for result in results)
+    with pytest.raises(ValueError):
+        list(batch.run(filepaths, ['unknown']))
+    for values in [{'layer_levels': 2}, {'layers': []}, {'exposure_time': 'abc'}, {'bottom_layers': 2.5}]:
+        with pytest.raises(ValueError):     # before any file is opened
+            list(batch.run(filepaths, [('set', values), 'write']))
+    assert cli.main(['batch', filepaths[0], '--set', 'version=1', '--in-place', '-q']) == 2
+    assert cli.main(['batch', filepaths[0], '--set', 'exposure_time=9', '--in-place', '-q']) == 0
+    assert photonfile.Photon(filepaths[0]).exposure_time == 9
+    assert cli.main(['batch', filepaths[2], '-q']) == 1
+
+def test_profiler(tmp_path):
+    import json
+    records = []
+    with photonfile.Profiler(trace_memory=True, callback=lambda *args: records.append(args)) as profiler:
+        photon = photonfile.Photon(REFERENCE)
+        photon.export_images(str(tmp_path / 'export'), mode='1')
+        photon.write(str(tmp_path / 'out.photon'))
+        photon.append_layers(str(tmp_path / 'export'))
+    assert photonfile._profiler is None
+    stages = profiler.summary()['stages']
+    assert stages['open']['layers'] == 10
+    assert stages['open.read']['bytes'] == os.path.getsize(REFERENCE)
+    assert stages['decode']['calls'] == stages['image_write']['calls'] == stages['image_read']['calls'] == 10
+    assert stages['write.layers']['layers'] == stages['encode']['layers'] == 10
+    assert stages['write']['bytes'] == os.path.getsize(str(tmp_path / 'out.photon'))
+    assert profiler.peak_memory > 0 and stages['decode']['peak_memory'] >= 0
+    assert len(records) == sum(stage['calls'] for stage in stages.values())
+    assert json.loads(profiler.report('json'))['stages']['decode']['calls'] == 10
+    assert 'image_write' in profiler.report()
+
+    with photonfile.Profiler() as profiler:  # keyword arguments and paths completed by np.save
+        photon.write(filepath=str(tmp_path / 'keyword.photon'))
+        photonfile.rle_to_imgarray(data=photon.layers[0].sublayers[0]._data)
+        photon.export_image(photon.layers[0].sublayers[0], str(tmp_path / 'layer'), mode='npy')
+    stages = profiler.summary()['stages']
+    assert stages['write']['bytes'] == os.path.getsize(str(tmp_path / 'keyword.photon'))
+    assert stages['decode']['bytes'] == 2 * len(photon.layers[0].sublayers[0]._data)  # export_image decodes as well
+    assert stages['image_write']['bytes'] == os.path.getsize(str(tmp_path / 'layer.npy'))
+
+def test_cli(tmp_path, capsys):
+    import json
+    import shutil
+    filepath = str(tmp_path / 'reference.photon')
+    shutil.copy(REFERENCE, filepath)
+    assert cli.main(['info', filepath, '--json']) == 0
+    info = json.loads(capsys.readouterr().out)
+    assert info['n_layers'] == 10 and info['resolution_x'] == 1440 and 'light_pwm' not in info
+    assert cli.main(['extract', filepath, str(tmp_path / 'layers'), '--layers', '2:5', '--workers', '2']) == 0
+    assert sorted(os.listdir(str(tmp_path / 'layers'))) == ['00002_00.png', '00003_00.png', '00004_00.png']
+    assert cli.main(['extract', filepath, str(tmp_path / 'all')]) == 0
+    assert cli.main(['pack', str(tmp_path / 'all'), str(tmp_path / 'packed.photon'), '--template', filepath, '--workers', '2']) == 0
+    packed = photonfile.Photon(str(tmp_path / 'packed.photon'))
+    assert packed.layers == photonfile.Photon(REFERENCE).layers
+    np.save(str(tmp_path / 'volume.npy'), np.stack([layer.sublayers[0].image for layer in packed.layers]))
+    assert cli.main(['pack', str(tmp_path / 'volume.npy'), str(tmp_path / 'volume.photon'), '--template', filepath]) == 0
+    assert photonfile.Photon(str(tmp_path / 'volume.photon')).layers == packed.layers
+    levels = np.zeros((2, 3, 2560, 1440), dtype=bool)   # anti-aliased volume without a template
+    levels[1, :, 100:200, 100:200] = True
+    np.save(str(tmp_path / 'aa.npy'), levels)
+    assert cli.main(['pack', str(tmp_path / 'aa.npy'), str(tmp_path / 'aa.cbddlp')]) == 0
+    assert photonfile.Photon(str(tmp_path / 'aa.cbddlp')).layers == photonfile.Photon.from_volume(levels).layers
+    photonfile.Photon(str(tmp_path / 'aa.cbddlp')).export_stack(str(tmp_path / 'stack.npy'))
+    assert cli.main(['pack', str(tmp_path / 'stack.npy'), str(tmp_path / 'stack.cbddlp'), '--workers', '2']) == 0
+    assert photonfile.Photon(str(tmp_path / 'stack.cbddlp')).layers == photonfile.Photon.from_volume(levels).layers
+    assert cli.main(['set', filepath, 'exposure_time=9', '--layer-parameters', 'exposure_time=8', '--layers', '0:3']) == 0
+    photon = photonfile.Photon(filepath)
+    assert photon.exposure_time == 9
+    assert photon.get_layer_parameters('exposure_time')[:, 0].tolist() == [8] * 3 + [1] * 7
+    assert cli.main(['set', filepath, 'version=2']) == 2
+    assert cli.main(['set', filepath, 'resolution_x=720']) == 2     # the layer data depends on the resolution
+    for value in ['bottom_layers=2.5', 'exposure_time=abc', 'bottom_layers=99999999999']:
+        assert cli.main(['set', filepath, value]) == 2
+        assert 'invalid value' in capsys.readouterr().err
+    assert cli.main(['set', filepath, '--layer-parameters', 'off_time=abc']) == 2
+    assert cli.main(['set', filepath, 'bottom_layers=3', 'exposure_time=7']) == 0
+    assert photonfile.Photon(filepath).bottom_layers == 3
+    capsys.readouterr()
+    assert cli.main(['stats', filepath, '--json', '--per-layer']) == 0
+    stats = json.loads(capsys.readouterr().out)
+    assert stats['layers'] == len(stats['area_mm2']) == 10
+    assert stats['volume_ml'] == pytest.approx(photon.statistics()['volume_ml'])
+
+def test_close(tmp_path):
+    with photonfile.Photon(REFERENCE, memory_map=True) as photon:
+        kept = photon.layers[1].sublayers[0]
+        kept._data = bytes(kept._data)
+        assert len(photon.layers[0].sublayers[0]._data) > 0
+    assert photon._mmap is None
+    assert len(kept._data) > 0  # modified layers stay accessible
+    with pytest.raises(ValueError):
+        photon.layers[0].sublayers[0]._data
+    photonfile.Photon(REFERENCE).close()    # nothing to release
+    truncated = str(tmp_path / 'truncated.photon')
+    with open(REFERENCE, 'rb') as f, open(truncated, 'wb') as out:
+        out.write(f.read(100))
+    for mode in [{'header_only': True}, {'memory_map': True}]:
+        with pytest.raises(Exception):
+            photonfile.Photon(truncated, **mode)
+    os.remove(truncated)    # no handle or mapping is left open
+
 def test_insert_layer():
-    raise NotImplementedError
+    photon = photonfile.Photon(REFERENCE)
+    original = list(photon.layers)
+    photon.insert_layer(photon.layers[5].sublayers[0]._data, 2)
+    assert len(photon.layers) == 11
+    assert photon.layers[2].sublayers[0]._data == original[5].sublayers[0]._data
+    assert photon.layers[3:] == original[2:]
+    photon.insert_layer(np.zeros((2560, 1440), dtype=bool), 0)
+    assert photon.layers[0].sublayers[0].image.sum() == 0
+    assert photon.layers[0].sublayers[0].exposure_time == photon.exposure_time_bottom
 
 def test_replace_layer():
-    raise NotImplementedError
+    photon = photonfile.Photon(REFERENCE)
+    original = list(photon.layers)
+    image = photon.layers[7].sublayers[0].image
+    photon.replace_layer(image, 3, exposure_time=5)
+    assert len(photon.layers) == 10
+    assert photon.layers[3].sublayers[0]._data == original[7].sublayers[0]._data
+    assert photon.layers[3].sublayers[0].exposure_time == 5
+    assert photon.layers[:3] == original[:3] and photon.layers[4:] == original[4:]
 
-def test_delete_layer():
-    raise NotImplementedError
\ No newline at end of file
+def test_delete_layer(tmp_path):
+    photon = photonfile.Photon(REFERENCE)
+    original = list(photon.layers)
+    photon.delete_layer(4)
+    assert photon.layers == original[:4] + original[5:]
+    photon.write(str(tmp_path / 'out.photon'))
+    assert photonfile.Photon(str(tmp_path / 'out.photon')).layers == original[:4] + original[5:]
\ No newline at end of file